@@ -70,8 +70,10 @@ if (options.harvest):
                        'XSMRPOOL_RECOVER']
 
 if (options.harvest):
+  rest_vars = [v.lower() for v in var_names_harvest]
+  rest_data = nffun.getvars(fname_restart, rest_vars)
   for v in range(0,len(var_names_harvest)):	
-    rest_vals = nffun.getvar(fname_restart, var_names_harvest[v].lower())
+    rest_vals = rest_data[v]
     #Loop through all valid values in the restart file.
     n_rest = len(rest_vals)
     for i in range(0,n_rest):
@@ -85,30 +87,32 @@ if (options.harvest):
         rest_vals[i] = 0.33/0.03/25.0
       elif (var_names_harvest[v] == 'FROOTN'):
         rest_vals[i] = 0.33/0.03/42.0
-    ierr = nffun.putvar(fname_restart, var_names_harvest[v].lower(), rest_vals)
+  ierr = nffun.putvars(fname_restart, dict(zip(rest_vars, rest_data)))
 else:
+  #read all history and restart variables in one pass over each file
+  hist_data = nffun.getvars(fname_hist, var_names+var_names2d)
+  rest_vars = [v.lower() for v in var_names+var_names2d]
+  rest_data = nffun.getvars(fname_restart, rest_vars+['fpg'])
   for v in range(0,len(var_names)):
-    hist_vals = nffun.getvar(fname_hist, var_names[v])
-    rest_vals = nffun.getvar(fname_restart, var_names[v].lower())
+    hist_vals = hist_data[v]
+    rest_vals = rest_data[v]
     #Loop through all valid values in the restart file.
     n_rest = len(rest_vals)
     for i in range(0,n_rest):
       if (float(rest_vals[i]) > 0.0 and float(hist_vals[0][i]) < 1.0e10 and float(hist_vals[0][i]) > 0.001):
         rest_vals[i] = hist_vals[0][i]
-    ierr = nffun.putvar(fname_restart, var_names[v].lower(), rest_vals)
 
   #get a single, non-depth dependent variable to count # of columns
-  rest_vals = nffun.getvar(fname_restart, 'fpg')
-  n_rest = len(rest_vals) 
-  for v in range(0,len(var_names2d)):
-    hist_vals = nffun.getvar(fname_hist, var_names2d[v])
-    rest_vals = nffun.getvar(fname_restart, var_names2d[v].lower())
+  n_rest = len(rest_data[-1]) 
+  for v in range(len(var_names),len(var_names)+len(var_names2d)):
+    hist_vals = hist_data[v]
+    rest_vals = rest_data[v]
     #Loop through all valid values in the restart file.
     for i in range(0,n_rest):
       for j in range(0,10):
         if (float(rest_vals[i][j]) > 0.0 and float(hist_vals[0][j][i]) < 1.0e10 and float(hist_vals[0][j][i]) > 1e-10):
           rest_vals[i][j] = hist_vals[0][j][i]
-    ierr = nffun.putvar(fname_restart, var_names2d[v].lower(), rest_vals)
+  ierr = nffun.putvars(fname_restart, dict(zip(rest_vars, rest_data)))
 
 #Remove negative Ppool values
 #os.system("ncap2 -O -s 'ppool=0.2*npool' "+fname_restart+" "+fname_restart)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import netcdf4_functions as nffun
+import ensemble_copy
 import os, sys, csv, time, math, numpy
 from optparse import OptionParser
 
@@ -45,6 +46,8 @@ parser.add_option('--machine', dest='machine', default='cades', \
                   help = 'machine')
 parser.add_option('--warming', dest='warming', default='0.0', \
                   help = 'warming level to apply')
+parser.add_option('--link_inputs', dest='link_inputs', default='', \
+                  help = 'Link inputs shared with the original case instead of copying (hard or sym)')
 (options, args) = parser.parse_args()
 
 
@@ -68,15 +71,15 @@ os.system('cp  '+orig_dir+'/*_in* '+new_dir)
 os.system('cp  '+orig_dir+'/*nml '+new_dir)
 if (not ('ICB' in casename)):
     os.system('cp  '+orig_dir+'/*stream* '+new_dir)
-os.system('cp  '+orig_dir+'/*.rc '+new_dir)
-os.system('cp  '+orig_dir+'/*para*.nc '+new_dir)
+ensemble_copy.stage_files(orig_dir, '*.rc', new_dir, options.link_inputs)
+ensemble_copy.stage_files(orig_dir, '*para*.nc', new_dir, options.link_inputs)
 
 #Change site name in relevant files
 
 for f in os.listdir(new_dir):
     if (os.path.isfile(new_dir+'/'+f) and (f[-2:] == 'in' or f[-3:] == 'nml' or 'streams' in f)):
         myinput=open(new_dir+'/'+f)
-        myoutput=open(new_dir+'/'+f+'.tmp','w')
+        output = []
         for s in myinput:
             if ('drv_in' in f and 'stop_n' in s and int(options.nyears) > 0):
                 s_out = ' stop_n = '+str(options.nyears)+'\n'
@@ -125,17 +128,20 @@ for f in os.listdir(new_dir):
                   s_out = s
             else:
                 s_out = s
-            myoutput.write(s_out)
-        myoutput.close()
+            output.append(s_out)
         myinput.close()
-        os.system(' mv '+new_dir+'/'+f+'.tmp '+new_dir+'/'+f)
+        #rewrite in place with a single write
+        myoutput=open(new_dir+'/'+f,'w')
+        myoutput.write(''.join(output))
+        myoutput.close()
 #Assume makepointdata has been run to generate surface and domain data
+#  (files in temp/ are regenerated for each site, so they are always copied)
 if (options.site_orig == options.site_new and os.path.exists(orig_dir+'/surfdata.nc')):
-  os.system('cp '+orig_dir+'/surfdata.nc '+new_dir)
+  ensemble_copy.stage_files(orig_dir, 'surfdata.nc', new_dir, options.link_inputs)
 else:
   os.system('cp temp/surfdata.nc '+new_dir)
 if (options.site_orig == options.site_new and os.path.exists(orig_dir+'/domain.nc')):
-  os.system('cp '+orig_dir+'/domain.nc '+new_dir)
+  ensemble_copy.stage_files(orig_dir, 'domain.nc', new_dir, options.link_inputs)
 else:
   os.system('cp temp/domain.nc '+new_dir)
 
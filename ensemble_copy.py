@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import netcdf4_functions as nffun
-import os, sys, csv, time, math, numpy
+import os, sys, csv, time, math, numpy, shutil, fnmatch, glob, threading
 from optparse import OptionParser
 
 #Create, run and process a CLM/ALM model ensemble member
@@ -12,271 +12,548 @@ from optparse import OptionParser
 #  DMRicciuto 12/1/2015
 #
 #  Note:  This will only work for single-point CLM/ALM compiled with MPI_SERIAL
+#
+#  Run as a script to stage one member (--ens_num) or many (--ens_range), or import
+#  and call stage_member() with parameter values already in memory (see manage_ensemble.py).
 
-#-------------------Parse options-----------------------------------------------
-
-parser = OptionParser()
-
-parser.add_option("--runroot", dest="runroot", default="../../run", \
-                  help="Directory where the run would be created")
-parser.add_option("--ens_num", dest="ens_num", default=1, \
-                  help="Ensemble member number")
-parser.add_option("--case", dest="casename", default="", \
-                  help="Name of case")
-parser.add_option("--ens_file", dest="ens_file", default="", \
-                  help="Name of samples file")
-parser.add_option("--parm_list", dest="parm_list", default='parm_list', \
-                  help = 'File containing list of parameters to vary')
-parser.add_option("--cnp", dest="cnp", default = False, action="store_true", \
-                  help = 'CNP mode - initialize P pools')
-parser.add_option("--site", dest="site", default='parm_list', \
-                  help = 'Site name')
-parser.add_option('--model_name', dest='model_name', default="clm2", \
-                    help='Model name used in restart file (clm2 or elm)')
-(options, args) = parser.parse_args()
-
-
-parm_names=[]
-parm_indices=[]
-parm_values=[]
-myinput = open(options.parm_list, 'r')
-casename = options.casename
-
-
-# get parameter names and PFT information
-pnum=0
-for s in myinput:
-   pdata = s.split()
-   parm_names.append(pdata[0])
-   if (pdata[0] == 'co2'):
-     pnum_co2 = pnum
-   if (len(pdata) == 3):
-     parm_indices.append(-1)
-   else:
-     parm_indices.append(int(pdata[1]))
-   pnum=pnum+1
-myinput.close()
+CNP_parms = ['ks_sorption', 'r_desorp', 'r_weather', 'r_adsorp', 'k_s1_biochem', 'smax', 'k_s3_biochem', \
+             'r_occlude', 'k_s4_biochem', 'k_s2_biochem']
 
 
-# get parameter values
-if (options.ens_file == ''):
-   myinput = open('./parm_data', 'r')
-   for s in myinput:    
-      parm_values.append(float(s))
+def read_parm_list(parm_list):
+   # get parameter names and PFT information
+   parm_names=[]
+   parm_indices=[]
+   myinput = open(parm_list, 'r')
+   for s in myinput:
+      pdata = s.split()
+      parm_names.append(pdata[0])
+      if (len(pdata) == 3):
+        parm_indices.append(-1)
+      else:
+        parm_indices.append(int(pdata[1]))
    myinput.close()
-   os.system('rm ./parm_data')
-else:
-   myinput = open(options.ens_file, 'r')
-   linenum = 1
+   return parm_names, parm_indices
+
+
+def read_ens_file(ens_file):
+   # get parameter values for all members (one row per member)
+   ens_values=[]
+   myinput = open(ens_file, 'r')
    for s in myinput:
-      if (int(options.ens_num) == linenum):
-         parm_values_str = s.split()
-         for v in parm_values_str:
-            parm_values.append(float(v))
-      linenum = linenum+1
+      ens_values.append([float(v) for v in s.split()])
    myinput.close()
+   return ens_values
 
-n_parameters = len(parm_names)
-gst=str(100000+int(options.ens_num))
-
-
-# create ensemble directory from original case 
-est = str(100000+int(options.ens_num))
-orig_dir = str(os.path.abspath(options.runroot)+'/'+casename+'/run')
-ens_dir  = os.path.abspath(options.runroot)+'/UQ/'+casename+'/g'+gst[1:]
-		
-os.system('mkdir -p '+options.runroot+'/UQ/'+casename+'/g'+gst[1:]+'/timing/checkpoints')
-os.system('cp  '+orig_dir+'/*_in* '+ens_dir)
-os.system('cp  '+orig_dir+'/*nml '+ens_dir)
-if (not ('CB' in casename)):
-    os.system('cp  '+orig_dir+'/*stream* '+ens_dir)
-os.system('cp  '+orig_dir+'/*.rc '+ens_dir)
-os.system('cp  '+orig_dir+'/surf*.nc '+ens_dir)
-os.system('cp  '+orig_dir+'/domain*.nc '+ens_dir)
-os.system('cp  '+orig_dir+'/*para*.nc '+ens_dir)
-
-
-# loop through all filenames, change directories in namelists, change parameter values
-for f in os.listdir(ens_dir):
-    if (os.path.isfile(ens_dir+'/'+f) and (f[-2:] == 'in' or f[-3:] == 'nml' or 'streams' in f)):
-        myinput=open(ens_dir+'/'+f)
-        myoutput=open(ens_dir+'/'+f+'.tmp','w')
-        for s in myinput:
-            if ('fates_paramfile' in s):
-                paramfile_orig = ((s.split()[2]).strip("'"))
-                if (paramfile_orig[0:2] == './'):
-                  paramfile_orig = orig_dir+'/'+paramfile_orig[2:]
-                paramfile_new  = ens_dir+'/fates_params_'+est[1:]+'.nc'
-                os.system('cp '+paramfile_orig+' '+paramfile_new)
-                os.system('nccopy -3 '+paramfile_new+' '+paramfile_new+'_tmp')
-                os.system('mv '+paramfile_new+'_tmp '+paramfile_new)
-                myoutput.write(" fates_paramfile = '"+paramfile_new+"'\n")
-                fates_paramfile = ens_dir+'/fates_params_'+est[1:]+'.nc'
-            elif ('paramfile' in s):
-                paramfile_orig = ((s.split()[2]).strip("'"))
-                if (paramfile_orig[0:2] == './'):
-                   paramfile_orig = orig_dir+'/'+paramfile_orig[2:]
-                paramfile_new  = ens_dir+'/clm_params_'+est[1:]+'.nc'
-                os.system('cp '+paramfile_orig+' '+paramfile_new)
-                os.system('nccopy -3 '+paramfile_new+' '+paramfile_new+'_tmp')
-                os.system('mv '+paramfile_new+'_tmp '+paramfile_new)
-                myoutput.write(" paramfile = '"+paramfile_new+"'\n")
-                pftfile = ens_dir+'/clm_params_'+est[1:]+'.nc'
-            elif ('ppmv' in s and 'co2' in parm_names):
-                myoutput.write(" co2_ppmv = "+str(parm_values[pnum_co2])+'\n')
-            elif ('fsoilordercon' in s):
-                CNPfile_orig = ((s.split()[2]).strip("'"))
-                if (CNPfile_orig[0:2] == './'):
-                   CNPfile_orig  = orig_dir+'/'+CNPfile_orig[2:]
-                CNPfile_new  = ens_dir+'/CNP_parameters_'+est[1:]+'.nc'
-                os.system('cp '+CNPfile_orig+' '+CNPfile_new)
-                os.system('nccopy -3 '+CNPfile_new+' '+CNPfile_new+'_tmp')
-                os.system('mv '+CNPfile_new+'_tmp '+CNPfile_new)
-                myoutput.write(" fsoilordercon = '"+CNPfile_new+"'\n")
-                CNPfile = ens_dir+'/CNP_parameters_'+est[1:]+'.nc'
-            elif ('fsurdat =' in s):
-                surffile_orig = ((s.split()[2]).strip("'"))
-                if (surffile_orig[0:2] == './'):
-                  surffile_orig = orig_dir+'/'+surffile_orig[2:]
-                surffile_new = ens_dir+'/surfdata_'+est[1:]+'.nc'
-                os.system('cp '+surffile_orig+' '+surffile_new)
-                os.system('nccopy -3 '+surffile_new+' '+surffile_new+'_tmp')
-                os.system('mv '+surffile_new+'_tmp '+surffile_new)
-                myoutput.write(" fsurdat = '"+surffile_new+"'\n")
-                surffile = ens_dir+'/surfdata_'+est[1:]+'.nc'
-            elif ('finidat = ' in s):
-                finidat_file_orig = ((s.split()[2]).strip("'"))
-                if (finidat_file_orig.strip() != ''):
-                   finidat_file_new  = ens_dir+'/'+(finidat_file_orig.split('/')[-1:])[0]
-                   if (finidat_file_orig[0:2] == './'):
-                      finidat_file_orig = orig_dir+'/'+finidat_file_orig[2:]
-                   #get finidat files from previous ensemble cases if available
-                   if (('1850' in casename or 'CROP' in casename) and not ('ad_spinup' in casename) and not \
-                          ('trans' in casename or '20TR' in casename)): 
-                      finidat_file_path = os.path.abspath(options.runroot)+'/UQ/'+casename.replace('1850CNP','1850CN')+'_ad_spinup/g'+gst[1:]
-                      if (os.path.exists(finidat_file_path)):
-                            finidat_file_orig = finidat_file_path+'/*.'+options.model_name+'.r.*.nc'
-                            os.system('python adjust_restart.py --rundir '+finidat_file_path+' --casename '+ \
-                                casename.replace('1850CNP','1850CN')+'_ad_spinup')
-                   if ('20TR' in casename):
-                      if ( not ('CO2' in casename)):
-                          finidat_file_path = os.path.abspath(options.runroot)+'/UQ/'+casename.replace('20TR','1850')+ \
-                                          '/g'+gst[1:]
-                          if (os.path.exists(finidat_file_path)):
-                              finidat_file_orig = finidat_file_path+'/*.'+options.model_name+'.r.*.nc'
-                              os.system('rm '+finidat_file_path+'/*ad_spinup*.'+options.model_name+'.r.*.nc')
-                      else: 
-                          finidat_file_path = os.path.abspath(options.runroot)+'/UQ/'+casename[:-5]+ \
-                                          '/g'+gst[1:]
-                          if (os.path.exists(finidat_file_path)):
-                              finidat_file_orig = finidat_file_path+'/*.'+options.model_name+'.r.*.nc'
-                              os.system('rm '+finidat_file_path+'/*1850*.'+options.model_name+'.r.*.nc')
-                   if ('trans' in casename):
-                      finidat_file_path = os.path.abspath(options.runroot)+'/UQ/'+casename.replace('_trans','')+ \
-                                       '/g'+gst[1:]
-                      if (os.path.exists(finidat_file_path)):
-                          finidat_file_orig = finidat_file_path+'/*.'+options.model_name+'.r.*.nc'
-                          os.system('rm '+finidat_file_path+'/*ad_spinup*.'+options.model_name+'.r.*.nc')
-                   os.system('cp '+finidat_file_orig+' '+finidat_file_new)
-                   myoutput.write(" finidat = '"+finidat_file_new+"'\n")
-                else:
-                   myoutput.write(s)
-            elif ('logfile =' in s):
-                os.system('date +%y%m%d-%H%M%S > mytime'+str(options.ens_num))
-                mytinput=open('./mytime'+str(options.ens_num),'r')
-                for st in mytinput:
-                    timestr = st.strip()
-                mytinput.close()
-                os.system('rm mytime'+str(options.ens_num))
-                myoutput.write(s.replace('`date +%y%m%d-%H%M%S`',timestr))
-            else:
-                myoutput.write(s.replace(orig_dir,ens_dir))
-        myoutput.close()
-        myinput.close()
-        os.system(' mv '+ens_dir+'/'+f+'.tmp '+ens_dir+'/'+f)
-
-pnum = 0
-CNP_parms = ['ks_sorption', 'r_desorp', 'r_weather', 'r_adsorp', 'k_s1_biochem', 'smax', 'k_s3_biochem', \
-             'r_occlude', 'k_s4_biochem', 'k_s2_biochem']
 
-fates_seed_zeroed=[False,False]
-for p in parm_names:
-   if ('INI' in p):
-      if ('BGC' in casename):
-         scalevars = ['soil3c_vr','soil3n_vr','soil3p_vr']
+def link_file(file_orig, file_new, link='hard'):
+   #Hardlink (link='hard') or symlink (link='sym') a shared read-only input into a
+   #  member directory.  Hard links fall back to a copy across file systems.
+   if (os.path.lexists(file_new)):
+      os.remove(file_new)
+   if (link == 'sym'):
+      os.symlink(os.path.abspath(file_orig), file_new)
+   else:
+      try:
+         os.link(file_orig, file_new)
+      except OSError:
+         shutil.copyfile(file_orig, file_new)
+
+
+def stage_files(orig_dir, pattern, ens_dir, link=''):
+   #copy (or link) the files in orig_dir matching pattern into ens_dir.  Existing
+   #  files are removed first so a copy never writes through an earlier link.
+   for f in glob.glob(orig_dir+'/'+pattern):
+      file_new = ens_dir+'/'+os.path.basename(f)
+      if (link != ''):
+         link_file(f, file_new, link)
       else:
-         scalevars = ['soil4c_vr','soil4n_vr','soil4p_vr']
-      sumvars = ['totsomc','totsomp','totcolc','totcoln','totcolp']
-      for v in scalevars:
-         myvar = nffun.getvar(finidat_file_new, v)
-         myvar = parm_values[pnum] * myvar
-         ierr = nffun.putvar(finidat_file_new, v, myvar)
-   elif (p == 'lai'):
-     myfile = surffile
-     param = nffun.getvar(myfile, 'MONTHLY_LAI')
-     param[:,:,:,:] = parm_values[pnum]
-     ierr = nffun.putvar(myfile, 'MONTHLY_LAI', param)
-   elif (p != 'co2'):
-      if (p in CNP_parms):
-         myfile= CNPfile
+         if (os.path.lexists(file_new)):
+            os.remove(file_new)
+         shutil.copyfile(f, file_new)
+
+
+def stage_ncfile(file_orig, file_new, prefix, template_dir='', link=''):
+   #Copy a netcdf input from the parent case to the member directory as NetCDF3.
+   #  If template_dir is given, the NetCDF3 conversion is done once per case and cached
+   #  there; members get a plain copy of the template.  With link ('hard' or 'sym') the
+   #  member file is a link to the template (or the original) for inputs it does not modify.
+   if (os.path.lexists(file_new)):
+      os.remove(file_new)
+   if (template_dir != ''):
+      template = template_dir+'/'+prefix+'_'+os.path.basename(file_orig)
+      if (not os.path.exists(template) or os.path.getmtime(template) < os.path.getmtime(file_orig)):
+         if (not os.path.exists(template_dir)):
+            os.makedirs(template_dir, exist_ok=True)
+         #convert to a private name and rename, so concurrent members never see a partial file
+         template_tmp = template+'.'+str(os.getpid())+'.'+str(threading.current_thread().ident)
+         ierr = os.system('nccopy -3 '+file_orig+' '+template_tmp)
+         if (ierr != 0 or not os.path.exists(template_tmp)):
+            print('Warning:  nccopy -3 failed for '+file_orig+'.  Copying without conversion')
+            template = file_orig
+         else:
+            os.rename(template_tmp, template)
+      if (link != ''):
+         link_file(template, file_new, link)
+      else:
+         shutil.copyfile(template, file_new)
+   elif (link != ''):
+      link_file(file_orig, file_new, link)
+   else:
+      os.system('cp '+file_orig+' '+file_new)
+      os.system('nccopy -3 '+file_new+' '+file_new+'_tmp')
+      os.system('mv '+file_new+'_tmp '+file_new)
+
+
+_namelist_templates = {}
+
+def namelist_templates(orig_dir, casename):
+   #Parse the namelist and stream files of the parent run directory once into templates.
+   #  Each line is stored as (kind, line, isco2, value):  'text' lines keep the line split
+   #  on orig_dir so the member directory can be joined in; input file lines (paramfile,
+   #  fsurdat, finidat, ...) keep the parent file path; co2_ppmv and logfile lines are
+   #  filled in per member.  Files matched by the copy patterns that are not namelists
+   #  are returned separately to be copied as is.  Templates are cached per run directory.
+   key = (orig_dir, 'CB' in casename)
+   if (key in _namelist_templates):
+      return _namelist_templates[key]
+   patterns = ['*_in*', '*nml']
+   if (not ('CB' in casename)):
+      patterns.append('*stream*')
+   templates = {}
+   copies = []
+   for f in sorted(os.listdir(orig_dir)):
+      if (not os.path.isfile(orig_dir+'/'+f) or not [p for p in patterns if fnmatch.fnmatch(f, p)]):
+         continue
+      if (not (f[-2:] == 'in' or f[-3:] == 'nml' or 'streams' in f)):
+         copies.append(f)
+         continue
+      templates[f] = []
+      myinput = open(orig_dir+'/'+f)
+      for s in myinput:
+         value = None
+         if ('fates_paramfile' in s):
+            kind = 'fates_paramfile'
+         elif ('paramfile' in s):
+            kind = 'paramfile'
+         elif ('fsoilordercon' in s):
+            kind = 'fsoilordercon'
+         elif ('fsurdat =' in s):
+            kind = 'fsurdat'
+         elif ('finidat = ' in s):
+            kind = 'finidat'
+            value = ((s.split()[2]).strip("'"))
+            if (value.strip() == ''):
+               kind = 'raw'
+         elif ('logfile =' in s):
+            kind = 'logfile'
+         else:
+            kind = 'text'
+            value = s.split(orig_dir)
+         if (kind in ['fates_paramfile', 'paramfile', 'fsoilordercon', 'fsurdat']):
+            value = ((s.split()[2]).strip("'"))
+            if (value[0:2] == './'):
+               value = orig_dir+'/'+value[2:]
+         #co2_ppmv is replaced only when co2 is a perturbed parameter
+         isco2 = ('ppmv' in s and not kind in ['fates_paramfile', 'paramfile'])
+         templates[f].append((kind, s, isco2, value))
+      myinput.close()
+   _namelist_templates[key] = (templates, copies)
+   return templates, copies
+
+
+def stage_finidat(finidat_file_orig, orig_dir, ens_dir, casename, gst, runroot, model_name):
+   #Copy the initial conditions file for a member, using restarts from the
+   #  preceding ensemble case when available.  Returns the member file name.
+   finidat_file_new  = ens_dir+'/'+(finidat_file_orig.split('/')[-1:])[0]
+   chained = False
+   if (finidat_file_orig[0:2] == './'):
+      finidat_file_orig = orig_dir+'/'+finidat_file_orig[2:]
+   #get finidat files from previous ensemble cases if available
+   if (('1850' in casename or 'CROP' in casename) and not ('ad_spinup' in casename) and not \
+          ('trans' in casename or '20TR' in casename)): 
+      finidat_file_path = os.path.abspath(runroot)+'/UQ/'+casename.replace('1850CNP','1850CN')+'_ad_spinup/g'+gst[1:]
+      if (os.path.exists(finidat_file_path)):
+            finidat_file_orig = finidat_file_path+'/*.'+model_name+'.r.*.nc'
+            chained = True
+            os.system('python adjust_restart.py --rundir '+finidat_file_path+' --casename '+ \
+                casename.replace('1850CNP','1850CN')+'_ad_spinup')
+   if ('20TR' in casename):
+      if ( not ('CO2' in casename)):
+          finidat_file_path = os.path.abspath(runroot)+'/UQ/'+casename.replace('20TR','1850')+ \
+                          '/g'+gst[1:]
+          if (os.path.exists(finidat_file_path)):
+              finidat_file_orig = finidat_file_path+'/*.'+model_name+'.r.*.nc'
+              chained = True
+              os.system('rm '+finidat_file_path+'/*ad_spinup*.'+model_name+'.r.*.nc')
+      else: 
+          finidat_file_path = os.path.abspath(runroot)+'/UQ/'+casename[:-5]+ \
+                          '/g'+gst[1:]
+          if (os.path.exists(finidat_file_path)):
+              finidat_file_orig = finidat_file_path+'/*.'+model_name+'.r.*.nc'
+              chained = True
+              os.system('rm '+finidat_file_path+'/*1850*.'+model_name+'.r.*.nc')
+   if ('trans' in casename):
+      finidat_file_path = os.path.abspath(runroot)+'/UQ/'+casename.replace('_trans','')+ \
+                       '/g'+gst[1:]
+      if (os.path.exists(finidat_file_path)):
+          finidat_file_orig = finidat_file_path+'/*.'+model_name+'.r.*.nc'
+          chained = True
+          os.system('rm '+finidat_file_path+'/*ad_spinup*.'+model_name+'.r.*.nc')
+   if (chained and len(glob.glob(finidat_file_orig)) == 0):
+      #e.g. the preceding case was run in scratch without --keep_restart
+      raise RuntimeError('Error: no restart file '+finidat_file_orig+' from the preceding ensemble case')
+   os.system('cp '+finidat_file_orig+' '+finidat_file_new)
+   return finidat_file_new
+
+
+def write_manifest(fname, parm_names, parm_indices, parm_values):
+   #Record the parameter values applied to a member, one "name index value" line each
+   #  in parm_list order, so postprocessing need not read them back from the inputs
+   myoutput = open(fname+'_tmp', 'w')
+   for pnum in range(0,len(parm_names)):
+      myoutput.write(parm_names[pnum]+' '+str(parm_indices[pnum])+' %.17g\n' % parm_values[pnum])
+   myoutput.close()
+   os.rename(fname+'_tmp', fname)
+
+
+def read_manifest(fname):
+   # parameter names, indices and values from a manifest (see write_manifest)
+   parm_names=[]
+   parm_indices=[]
+   parm_values=[]
+   myinput = open(fname, 'r')
+   for s in myinput:
+      pdata = s.split()
+      parm_names.append(pdata[0])
+      parm_indices.append(int(pdata[1]))
+      parm_values.append(float(pdata[2]))
+   myinput.close()
+   return parm_names, parm_indices, parm_values
+
+
+def perturbed_files(parm_names):
+   #which member input files the parameter list modifies (see parm_files in stage_member)
+   perturbed = {'surfdata': False, 'clm_params': False, 'CNP_parameters': False, 'fates_params': False}
+   for p in parm_names:
+      if (p == 'lai'):
+         perturbed['surfdata'] = True
+      elif (p in CNP_parms):
+         perturbed['CNP_parameters'] = True
       elif ('fates' in p):
-         myfile = fates_paramfile
+         perturbed['fates_params'] = True
+      elif (not ('INI' in p) and p != 'co2'):
+         perturbed['clm_params'] = True
+   return perturbed
+
+
+def stage_member(casename, ens_num, parm_values, parm_names, parm_indices, runroot='../../run', \
+                 model_name='clm2', stage_templates=False, link_inputs='', ens_root=''):
+   #Create the run directory UQ/<casename>/g<ens_num> from the parent case, point its
+   #  namelists at member copies of the inputs and apply parm_values (ordered as
+   #  parm_names/parm_indices from read_parm_list), recording them in the manifest
+   #  parm_values_<ens_num>.txt.  Returns the member run directory.
+   #  With link_inputs ('hard' or 'sym'), inputs the parameter list does not modify are
+   #  linked instead of copied; they must not be modified in place afterwards.
+   #  With ens_root (e.g. node-local scratch), the member directory is created under
+   #  ens_root/UQ instead of runroot/UQ; the parent case is still read from runroot.
+   for pnum in range(0,len(parm_names)):
+      if (parm_names[pnum] == 'co2'):
+         pnum_co2 = pnum
+   template_dir = ''
+   if (stage_templates):
+      template_dir = os.path.abspath(runroot)+'/UQ/'+casename+'/templates'
+   links = {}
+   for prefix, perturbed in perturbed_files(parm_names).items():
+      links[prefix] = ''
+      if (not perturbed):
+         links[prefix] = link_inputs
+
+   n_parameters = len(parm_names)
+   gst=str(100000+int(ens_num))
+
+
+   # create ensemble directory from original case 
+   est = str(100000+int(ens_num))
+   orig_dir = str(os.path.abspath(runroot)+'/'+casename+'/run')
+   if (ens_root == ''):
+      ens_root = runroot
+   ens_dir  = os.path.abspath(ens_root)+'/UQ/'+casename+'/g'+gst[1:]
+
+   os.system('mkdir -p '+ens_dir+'/timing/checkpoints')
+   for pattern in ['*.rc', 'surf*.nc', 'domain*.nc', '*para*.nc']:
+      stage_files(orig_dir, pattern, ens_dir, link_inputs)
+
+
+   # render namelists from the parent case templates, staging member input files
+   templates, copies = namelist_templates(orig_dir, casename)
+   for f in copies:
+       shutil.copy(orig_dir+'/'+f, ens_dir+'/'+f)
+   timestr = time.strftime('%y%m%d-%H%M%S')
+   for f in templates:
+       output = []
+       for kind, s, isco2, value in templates[f]:
+           if (isco2 and 'co2' in parm_names):
+               output.append(" co2_ppmv = "+str(parm_values[pnum_co2])+'\n')
+           elif (kind == 'fates_paramfile'):
+               paramfile_new  = ens_dir+'/fates_params_'+est[1:]+'.nc'
+               stage_ncfile(value, paramfile_new, 'fates_params', template_dir, links['fates_params'])
+               output.append(" fates_paramfile = '"+paramfile_new+"'\n")
+               fates_paramfile = paramfile_new
+           elif (kind == 'paramfile'):
+               paramfile_new  = ens_dir+'/clm_params_'+est[1:]+'.nc'
+               stage_ncfile(value, paramfile_new, 'clm_params', template_dir, links['clm_params'])
+               output.append(" paramfile = '"+paramfile_new+"'\n")
+               pftfile = paramfile_new
+           elif (kind == 'fsoilordercon'):
+               CNPfile_new  = ens_dir+'/CNP_parameters_'+est[1:]+'.nc'
+               stage_ncfile(value, CNPfile_new, 'CNP_parameters', template_dir, links['CNP_parameters'])
+               output.append(" fsoilordercon = '"+CNPfile_new+"'\n")
+               CNPfile = CNPfile_new
+           elif (kind == 'fsurdat'):
+               surffile_new = ens_dir+'/surfdata_'+est[1:]+'.nc'
+               stage_ncfile(value, surffile_new, 'surfdata', template_dir, links['surfdata'])
+               output.append(" fsurdat = '"+surffile_new+"'\n")
+               surffile = surffile_new
+           elif (kind == 'finidat'):
+               finidat_file_new = stage_finidat(value, orig_dir, ens_dir, casename, gst, runroot, model_name)
+               output.append(" finidat = '"+finidat_file_new+"'\n")
+           elif (kind == 'logfile'):
+               output.append(s.replace('`date +%y%m%d-%H%M%S`',timestr))
+           elif (kind == 'raw'):
+               output.append(s)
+           else:
+               output.append(ens_dir.join(value))
+       myoutput = open(ens_dir+'/'+f,'w')
+       myoutput.write(''.join(output))
+       myoutput.close()
+
+   #find the file and variables modified by each parameter
+   parm_files = []
+   parm_vars  = []
+   for p in parm_names:
+      if ('INI' in p):
+         if ('BGC' in casename):
+            scalevars = ['soil3c_vr','soil3n_vr','soil3p_vr']
+         else:
+            scalevars = ['soil4c_vr','soil4n_vr','soil4p_vr']
+         parm_files.append(finidat_file_new)
+         parm_vars.append(scalevars)
+      elif (p == 'lai'):
+         parm_files.append(surffile)
+         parm_vars.append(['MONTHLY_LAI'])
+      elif (p != 'co2'):
+         if (p in CNP_parms):
+            myfile= CNPfile
+         elif ('fates' in p):
+            myfile = fates_paramfile
+         else:
+            myfile = pftfile
+         if (p == 'dayl_scaling' or p == 'vcmaxse'):
+           os.system('ncap2 -O -s "'+p+' = flnr" '+myfile+' '+myfile)
+           print('Creting netcdf variable for '+p)
+         parm_files.append(myfile)
+         parm_vars.append([p])
       else:
-         myfile = pftfile
-      param = nffun.getvar(myfile,p)
-      if (('fates_prt' in p and 'stoich' in p) or ('fates_turnover' in p and 'retrans' in p)):
-        #this is a 2D parameter.
-         param[parm_indices[pnum] % 12 , parm_indices[pnum] / 12] = parm_values[pnum]
-         param[parm_indices[pnum] % 12 , parm_indices[pnum] / 12] = parm_values[pnum]
-      elif ('fates_hydr_p50_node' in p or 'fates_hydr_avuln_node' in p or 'fates_hydr_kmax_node' in p or \
-            'fates_hydr_pitlp_node' in p or 'fates_hydr_thetas_node' in p):
-         param[parm_indices[pnum] / 12 , parm_indices[pnum] % 12] = parm_values[pnum]
-         param[parm_indices[pnum] / 12 , parm_indices[pnum] % 12] = parm_values[pnum]
-      elif ('fates_leaf_long' in p or 'fates_leaf_vcmax25top' in p):
-         param[0,parm_indices[pnum]] = parm_values[pnum]
-      #elif (p == 'fates_seed_alloc'):
-      #    if (not fates_seed_zeroed[0]):
-      #       param[:]=0.
-      #       fates_seed_zeroed[0]=True
-      #    param[parm_indices[pnum]] = parm_values[pnum]
-      #elif (p == 'fates_seed_alloc_mature'):
-      #    if (not fates_seed_zeroed[1]):
-      #       param[:]=0.
-      #       fates_seed_zeroed[1]=True
-      #    param[parm_indices[pnum]] = parm_values[pnum]             
-      elif (p == 'dayl_scaling' or p == 'vcmaxse'):
-        os.system('ncap2 -O -s "'+p+' = flnr" '+myfile+' '+myfile)
-        print('Creting netcdf variable for '+p)
-        param = nffun.getvar(myfile,'flnr')
-        param[:] = parm_values[pnum]
-      elif (p == 'psi50'):
-        param[:,parm_indices[pnum]] = parm_values[pnum]
-      elif (parm_indices[pnum] > 0):
-         param[parm_indices[pnum]] = parm_values[pnum]
-      elif (parm_indices[pnum] == 0):
-         try:
+         parm_files.append('')
+         parm_vars.append([])
+
+   #read every variable to be modified with one open per file
+   file_vars = {}
+   for f in range(0,n_parameters):
+      if (parm_files[f] != ''):
+         if (not parm_files[f] in file_vars):
+            file_vars[parm_files[f]] = []
+         for v in parm_vars[f]:
+            if (not v in file_vars[parm_files[f]]):
+               file_vars[parm_files[f]].append(v)
+   file_data = {}
+   for myfile in file_vars:
+      file_data[myfile] = dict(zip(file_vars[myfile], nffun.getvars(myfile, file_vars[myfile])))
+
+   pnum = 0
+   fates_seed_zeroed=[False,False]
+   for p in parm_names:
+      if ('INI' in p):
+         for v in parm_vars[pnum]:
+            myvar = file_data[finidat_file_new][v]
+            file_data[finidat_file_new][v] = parm_values[pnum] * myvar
+      elif (p == 'lai'):
+        param = file_data[surffile]['MONTHLY_LAI']
+        param[:,:,:,:] = parm_values[pnum]
+      elif (p != 'co2'):
+         myfile = parm_files[pnum]
+         param = file_data[myfile][p]
+         if (('fates_prt' in p and 'stoich' in p) or ('fates_turnover' in p and 'retrans' in p)):
+           #this is a 2D parameter.
+            param[parm_indices[pnum] % 12 , parm_indices[pnum] / 12] = parm_values[pnum]
+            param[parm_indices[pnum] % 12 , parm_indices[pnum] / 12] = parm_values[pnum]
+         elif ('fates_hydr_p50_node' in p or 'fates_hydr_avuln_node' in p or 'fates_hydr_kmax_node' in p or \
+               'fates_hydr_pitlp_node' in p or 'fates_hydr_thetas_node' in p):
+            param[parm_indices[pnum] / 12 , parm_indices[pnum] % 12] = parm_values[pnum]
+            param[parm_indices[pnum] / 12 , parm_indices[pnum] % 12] = parm_values[pnum]
+         elif ('fates_leaf_long' in p or 'fates_leaf_vcmax25top' in p):
+            param[0,parm_indices[pnum]] = parm_values[pnum]
+         #elif (p == 'fates_seed_alloc'):
+         #    if (not fates_seed_zeroed[0]):
+         #       param[:]=0.
+         #       fates_seed_zeroed[0]=True
+         #    param[parm_indices[pnum]] = parm_values[pnum]
+         #elif (p == 'fates_seed_alloc_mature'):
+         #    if (not fates_seed_zeroed[1]):
+         #       param[:]=0.
+         #       fates_seed_zeroed[1]=True
+         #    param[parm_indices[pnum]] = parm_values[pnum]             
+         elif (p == 'dayl_scaling' or p == 'vcmaxse'):
+           #variable was created from flnr above
            param[:] = parm_values[pnum]
-         except:
-           param = parm_values[pnum]
-      ierr = nffun.putvar(myfile, p, param)
-      #if ('fr_flig' in p):
-      #   param=nffun.getvar(myfile, 'fr_fcel')
-      #   param[parm_indices[pnum]]=1.0-parm_values[pnum]-parm_values[pnum-1]
-      #   ierr = nffun.putvar(myfile, 'fr_fcel', param)
-   pnum = pnum+1
-
-#ensure FATES seed allocation paramters sum to one
-#if (fates_seed_zeroed[0]):
-#  param = nffun.getvar(myfile,'fates_seed_alloc')
-#  param2 = nffun.getvar(myfile,'fates_seed_alloc_mature')
-#  for i in range(0,12):
-#    if (param[i] + param2[i] > 1.0):
-#      sumparam= param[i]+param2[i]
-#      param[i]  = param[i]/sumparam
-#      param2[i] = param2[i]/sumparam
-#  ierr = nffun.putvar(myfile, 'fates_seed_alloc', param)      
-#  ierr = nffun.putvar(myfile, 'fates_seed_alloc_mature', param2)
+         elif (p == 'psi50'):
+           param[:,parm_indices[pnum]] = parm_values[pnum]
+         elif (parm_indices[pnum] > 0):
+            param[parm_indices[pnum]] = parm_values[pnum]
+         elif (parm_indices[pnum] == 0):
+            try:
+              param[:] = parm_values[pnum]
+            except:
+              param = parm_values[pnum]
+         file_data[myfile][p] = param
+         #if ('fr_flig' in p):
+         #   param=nffun.getvar(myfile, 'fr_fcel')
+         #   param[parm_indices[pnum]]=1.0-parm_values[pnum]-parm_values[pnum-1]
+         #   ierr = nffun.putvar(myfile, 'fr_fcel', param)
+      pnum = pnum+1
+
+   #write all modified variables with one open per file
+   for myfile in file_data:
+      ierr = nffun.putvars(myfile, file_data[myfile])
+
+   #ensure FATES seed allocation paramters sum to one
+   #if (fates_seed_zeroed[0]):
+   #  param = nffun.getvar(myfile,'fates_seed_alloc')
+   #  param2 = nffun.getvar(myfile,'fates_seed_alloc_mature')
+   #  for i in range(0,12):
+   #    if (param[i] + param2[i] > 1.0):
+   #      sumparam= param[i]+param2[i]
+   #      param[i]  = param[i]/sumparam
+   #      param2[i] = param2[i]/sumparam
+   #  ierr = nffun.putvar(myfile, 'fates_seed_alloc', param)      
+   #  ierr = nffun.putvar(myfile, 'fates_seed_alloc_mature', param2)
 
+   write_manifest(ens_dir+'/parm_values_'+est[1:]+'.txt', parm_names, parm_indices, parm_values)
+
+   #release member files before the model opens them
+   nffun.close_all()
+   return ens_dir
+
+
+def parse_ens_range(ens_range):
+   # member numbers from a range and/or list, e.g. "1:100" or "1,5,7" or "1:10,15"
+   #  (ranges include both ends)
+   ens_nums = []
+   for r in ens_range.split(','):
+      if (':' in r):
+         start, end = r.split(':')
+         ens_nums.extend(range(int(start), int(end)+1))
+      elif (r.strip() != ''):
+         ens_nums.append(int(r))
+   return ens_nums
+
+
+def stage_members(casename, ens_nums, ens_values, parm_names, parm_indices, nthreads=4, **kwargs):
+   #Stage several members from one process using a bounded pool of threads (netcdf
+   #  reads and writes are serialized in netcdf4_functions; copies and nccopy run
+   #  concurrently).  The first member is staged alone so that the namelist and
+   #  netcdf templates are built once.  Returns the list of members that failed.
+   from concurrent.futures import ThreadPoolExecutor
+   failed = []
+   def stage(n):
+      try:
+         stage_member(casename, n, ens_values[n-1], parm_names, parm_indices, **kwargs)
+      except Exception as e:
+         print('Error staging member '+str(n)+': '+str(e))
+         failed.append(n)
+   if (len(ens_nums) > 0):
+      stage(ens_nums[0])
+   pool = ThreadPoolExecutor(max_workers=max(int(nthreads), 1))
+   for n in ens_nums[1:]:
+      pool.submit(stage, n)
+   pool.shutdown(wait=True)
+   return sorted(failed)
+
+
+if __name__ == '__main__':
+
+   #-------------------Parse options-----------------------------------------------
+
+   parser = OptionParser()
+
+   parser.add_option("--runroot", dest="runroot", default="../../run", \
+                     help="Directory where the run would be created")
+   parser.add_option("--ens_num", dest="ens_num", default=1, \
+                     help="Ensemble member number")
+   parser.add_option("--case", dest="casename", default="", \
+                     help="Name of case")
+   parser.add_option("--ens_range", dest="ens_range", default="", \
+                     help="Stage several members, e.g. 1:100 or 1,5,7 (requires --ens_file)")
+   parser.add_option("--nthreads", dest="nthreads", default=4, \
+                     help="Number of threads used with --ens_range")
+   parser.add_option("--ens_file", dest="ens_file", default="", \
+                     help="Name of samples file")
+   parser.add_option("--parm_list", dest="parm_list", default='parm_list', \
+                     help = 'File containing list of parameters to vary')
+   parser.add_option("--cnp", dest="cnp", default = False, action="store_true", \
+                     help = 'CNP mode - initialize P pools')
+   parser.add_option("--site", dest="site", default='parm_list', \
+                     help = 'Site name')
+   parser.add_option('--model_name', dest='model_name', default="clm2", \
+                       help='Model name used in restart file (clm2 or elm)')
+   parser.add_option('--stage_templates', dest='stage_templates', default=False, action='store_true', \
+                       help='Copy netcdf inputs from cached NetCDF3 templates of the parent case')
+   parser.add_option('--link_inputs', dest='link_inputs', default='', \
+                       help='Link inputs not modified by the parameter list instead of copying (hard or sym)')
+   parser.add_option('--ens_root', dest='ens_root', default='', \
+                       help='Create member directories under this root (e.g. node-local scratch) instead of runroot')
+   (options, args) = parser.parse_args()
+
+   parm_names, parm_indices = read_parm_list(options.parm_list)
+
+   if (options.ens_range != ''):
+      if (options.ens_file == ''):
+         print('Error:  --ens_range requires --ens_file')
+         sys.exit(1)
+      ens_values = read_ens_file(options.ens_file)
+      failed = stage_members(options.casename, parse_ens_range(options.ens_range), ens_values, \
+                             parm_names, parm_indices, nthreads=options.nthreads, \
+                             runroot=options.runroot, model_name=options.model_name, \
+                             stage_templates=options.stage_templates, link_inputs=options.link_inputs, \
+                             ens_root=options.ens_root)
+      if (len(failed) > 0):
+         print('Failed to stage members: '+' '.join([str(n) for n in failed]))
+         sys.exit(1)
+      sys.exit(0)
+
+   # get parameter values
+   parm_values=[]
+   if (options.ens_file == ''):
+      myinput = open('./parm_data', 'r')
+      for s in myinput:    
+         parm_values.append(float(s))
+      myinput.close()
+      os.system('rm ./parm_data')
+   else:
+      myinput = open(options.ens_file, 'r')
+      linenum = 1
+      for s in myinput:
+         if (int(options.ens_num) == linenum):
+            parm_values_str = s.split()
+            for v in parm_values_str:
+               parm_values.append(float(v))
+         linenum = linenum+1
+      myinput.close()
 
+   stage_member(options.casename, options.ens_num, parm_values, parm_names, parm_indices, \
+                runroot=options.runroot, model_name=options.model_name, \
+                stage_templates=options.stage_templates, link_inputs=options.link_inputs, \
+                ens_root=options.ens_root)
 
 ### END ###
@@ -394,13 +394,8 @@ for n in range(0,n_grids):
 
 
     if (issite):
-        frac = nffun.getvar(domainfile_new, 'frac')
-        mask = nffun.getvar(domainfile_new, 'mask')
-        xc = nffun.getvar(domainfile_new, 'xc')
-        yc = nffun.getvar(domainfile_new, 'yc')
-        xv = nffun.getvar(domainfile_new, 'xv')
-        yv = nffun.getvar(domainfile_new, 'yv')
-        area = nffun.getvar(domainfile_new, 'area')
+        frac, mask, xc, yc, xv, yv, area = nffun.getvars(domainfile_new, \
+          ['frac', 'mask', 'xc', 'yc', 'xv', 'yv', 'area'])
         frac[0] = 1.0
         mask[0] = 1
         if (options.site != ''):
@@ -415,11 +410,7 @@ for n in range(0,n_grids):
             yv[0][0][2] = lat[n]+resy/2
             yv[0][0][3] = lat[n]+resy/2
             area[0] = resx*resy*math.pi/180*math.pi/180
-            ierr = nffun.putvar(domainfile_new, 'xc', xc)
-            ierr = nffun.putvar(domainfile_new, 'yc', yc)
-            ierr = nffun.putvar(domainfile_new, 'xv', xv)
-            ierr = nffun.putvar(domainfile_new, 'yv', yv)
-            ierr = nffun.putvar(domainfile_new, 'area', area)
+            ierr = nffun.putvars(domainfile_new, {'xc': xc, 'yc': yc, 'xv': xv, 'yv': yv, 'area': area})
             
         elif (options.point_area_km2 != None or options.point_area_deg2 != None):
             xc[0] = lon[n]
@@ -435,14 +426,10 @@ for n in range(0,n_grids):
             area[0] = area[0]*xscalar*yscalar
             if(options.point_area_km2 != None):
                 area[0] = float(options.point_area_km2)/re_km/re_km # there is about 0.3% error with calculation above
-            ierr = nffun.putvar(domainfile_new, 'xc', xc)
-            ierr = nffun.putvar(domainfile_new, 'yc', yc)
-            ierr = nffun.putvar(domainfile_new, 'xv', xv)
-            ierr = nffun.putvar(domainfile_new, 'yv', yv)
-            ierr = nffun.putvar(domainfile_new, 'area', area)
+            ierr = nffun.putvars(domainfile_new, {'xc': xc, 'yc': yc, 'xv': xv, 'yv': yv, 'area': area})
         
-        ierr = nffun.putvar(domainfile_new, 'frac', frac)
-        ierr = nffun.putvar(domainfile_new, 'mask', mask)
+        ierr = nffun.putvars(domainfile_new, {'frac': frac, 'mask': mask})
+        nffun.close_all(domainfile_new)
         os.system('ncks -h -O --mk_rec_dim nj '+domainfile_new+' '+domainfile_new)
     elif (options.mymask != ''):
        print('Applying mask from '+options.mymask)
@@ -450,10 +437,13 @@ for n in range(0,n_grids):
               ','+str(ygrid_max[n])+' '+options.mymask+' mask_temp.nc')
        newmask = nffun.getvar('mask_temp.nc', 'PNW_mask')
        ierr = nffun.putvar(domainfile_new, 'mask', newmask)
+       nffun.close_all('mask_temp.nc')
        os.system('rm mask_temp.nc')
 
     domainfile_old = domainfile_new
 
+#release cached handles before NCO tools read the per-point files
+nffun.close_all()
 domainfile_new = './temp/domain.nc'
 if (n_grids > 1):
     #ierr = os.system('ncrcat -h '+domainfile_list+' '+domainfile_new) # OS error if '_list' too long
@@ -513,18 +503,11 @@ for n in range(0,n_grids):
              ' -d lsmlat,'+str(ygrid_min[n])+','+str(ygrid_max[n])+' '+surffile_orig+' '+surffile_new)
 
     if (issite):
-        landfrac_pft = nffun.getvar(surffile_new, 'LANDFRAC_PFT')
-        pftdata_mask = nffun.getvar(surffile_new, 'PFTDATA_MASK')
-        longxy       = nffun.getvar(surffile_new, 'LONGXY')
-        latixy       = nffun.getvar(surffile_new, 'LATIXY')
-        area         = nffun.getvar(surffile_new, 'AREA')
-        pct_wetland  = nffun.getvar(surffile_new, 'PCT_WETLAND')
-        pct_lake     = nffun.getvar(surffile_new, 'PCT_LAKE')
-        pct_glacier  = nffun.getvar(surffile_new, 'PCT_GLACIER')
-        pct_urban    = nffun.getvar(surffile_new, 'PCT_URBAN')
+        landfrac_pft, pftdata_mask, longxy, latixy, area, pct_wetland, pct_lake, pct_glacier, \
+          pct_urban = nffun.getvars(surffile_new, ['LANDFRAC_PFT', 'PFTDATA_MASK', 'LONGXY', \
+          'LATIXY', 'AREA', 'PCT_WETLAND', 'PCT_LAKE', 'PCT_GLACIER', 'PCT_URBAN'])
         if (options.mymodel == 'CLM5' or options.crop):
-          pct_crop = nffun.getvar(surffile_new, 'PCT_CROP')
-          pct_cft  = nffun.getvar(surffile_new, 'PCT_CFT')
+          pct_crop, pct_cft = nffun.getvars(surffile_new, ['PCT_CROP', 'PCT_CFT'])
           #put fake P data in this datset
           vars_in = ['LABILE_P','APATITE_P','SECONDARY_P','OCCLUDED_P']
           soil_order = 1
@@ -532,29 +515,20 @@ for n in range(0,n_grids):
           primp = 1.0
           secondp = 1.0
           occlp = 1.0
+          nffun.close_all(surffile_new)
           tempdata = Dataset(surffile_new, 'a')
           for v in vars_in:
             tempvar = tempdata.createVariable(v, 'f4',('lsmlat','lsmlon',))
           tempvar = tempdata.createVariable('SOIL_ORDER', 'i4',('lsmlat','lsmlon',))
           tempdata.close()
         else:
-          soil_order   = nffun.getvar(surffile_new, 'SOIL_ORDER')
-          labilep      = nffun.getvar(surffile_new, 'LABILE_P')
-          primp        = nffun.getvar(surffile_new, 'APATITE_P')
-          secondp      = nffun.getvar(surffile_new, 'SECONDARY_P')
-          occlp        = nffun.getvar(surffile_new, 'OCCLUDED_P')
+          soil_order, labilep, primp, secondp, occlp = nffun.getvars(surffile_new, \
+            ['SOIL_ORDER', 'LABILE_P', 'APATITE_P', 'SECONDARY_P', 'OCCLUDED_P'])
         #input from site-specific information
-        soil_color   = nffun.getvar(surffile_new, 'SOIL_COLOR')
-        pct_sand     = nffun.getvar(surffile_new, 'PCT_SAND')
-        pct_clay     = nffun.getvar(surffile_new, 'PCT_CLAY')
-        organic      = nffun.getvar(surffile_new, 'ORGANIC')
-        fmax         = nffun.getvar(surffile_new, 'FMAX')
-        pct_nat_veg  = nffun.getvar(surffile_new, 'PCT_NATVEG')
-        pct_pft      = nffun.getvar(surffile_new, 'PCT_NAT_PFT') 
-        monthly_lai  = nffun.getvar(surffile_new, 'MONTHLY_LAI')
-        monthly_sai  = nffun.getvar(surffile_new, 'MONTHLY_SAI')
-        monthly_height_top = nffun.getvar(surffile_new, 'MONTHLY_HEIGHT_TOP')
-        monthly_height_bot = nffun.getvar(surffile_new, 'MONTHLY_HEIGHT_BOT')
+        soil_color, pct_sand, pct_clay, organic, fmax, pct_nat_veg, pct_pft, monthly_lai, \
+          monthly_sai, monthly_height_top, monthly_height_bot = nffun.getvars(surffile_new, \
+          ['SOIL_COLOR', 'PCT_SAND', 'PCT_CLAY', 'ORGANIC', 'FMAX', 'PCT_NATVEG', 'PCT_NAT_PFT', \
+           'MONTHLY_LAI', 'MONTHLY_SAI', 'MONTHLY_HEIGHT_TOP', 'MONTHLY_HEIGHT_BOT'])
 
         npft = 17
         npft_crop = 0
@@ -714,34 +688,19 @@ for n in range(0,n_grids):
 
 
 
-        ierr = nffun.putvar(surffile_new, 'LANDFRAC_PFT', landfrac_pft)
-        ierr = nffun.putvar(surffile_new, 'PFTDATA_MASK', pftdata_mask)
-        ierr = nffun.putvar(surffile_new, 'LONGXY', longxy)
-        ierr = nffun.putvar(surffile_new, 'LATIXY', latixy)
-        ierr = nffun.putvar(surffile_new, 'AREA', area)
-        ierr = nffun.putvar(surffile_new, 'PCT_WETLAND', pct_wetland)
-        ierr = nffun.putvar(surffile_new, 'PCT_LAKE', pct_lake)
-        ierr = nffun.putvar(surffile_new, 'PCT_GLACIER',pct_glacier)
-        ierr = nffun.putvar(surffile_new, 'PCT_URBAN', pct_urban)
+        surfvars = {'LANDFRAC_PFT': landfrac_pft, 'PFTDATA_MASK': pftdata_mask, 'LONGXY': longxy, \
+                    'LATIXY': latixy, 'AREA': area, 'PCT_WETLAND': pct_wetland, 'PCT_LAKE': pct_lake, \
+                    'PCT_GLACIER': pct_glacier, 'PCT_URBAN': pct_urban}
         if (options.mymodel == 'CLM5' or options.crop):
-            ierr = nffun.putvar(surffile_new, 'PCT_CROP', pct_crop)
-            ierr = nffun.putvar(surffile_new, 'PCT_CFT', pct_cft)
-       
-        ierr = nffun.putvar(surffile_new, 'SOIL_ORDER', soil_order)
-        ierr = nffun.putvar(surffile_new, 'LABILE_P', labilep)
-        ierr = nffun.putvar(surffile_new, 'APATITE_P', primp)
-        ierr = nffun.putvar(surffile_new, 'SECONDARY_P', secondp)
-        ierr = nffun.putvar(surffile_new, 'OCCLUDED_P', occlp)
-        ierr = nffun.putvar(surffile_new, 'SOIL_COLOR', soil_color)
-        ierr = nffun.putvar(surffile_new, 'FMAX', fmax)
-        ierr = nffun.putvar(surffile_new, 'ORGANIC', organic)
-        ierr = nffun.putvar(surffile_new, 'PCT_SAND', pct_sand)
-        ierr = nffun.putvar(surffile_new, 'PCT_CLAY', pct_clay)
-        ierr = nffun.putvar(surffile_new, 'PCT_NATVEG', pct_nat_veg)
-        ierr = nffun.putvar(surffile_new, 'PCT_NAT_PFT', pct_pft)
-        ierr = nffun.putvar(surffile_new, 'MONTHLY_HEIGHT_TOP', monthly_height_top)
-        ierr = nffun.putvar(surffile_new, 'MONTHLY_HEIGHT_BOT', monthly_height_bot)
-        ierr = nffun.putvar(surffile_new, 'MONTHLY_LAI', monthly_lai)
+            surfvars['PCT_CROP'] = pct_crop
+            surfvars['PCT_CFT']  = pct_cft
+        surfvars.update({'SOIL_ORDER': soil_order, 'LABILE_P': labilep, 'APATITE_P': primp, \
+                    'SECONDARY_P': secondp, 'OCCLUDED_P': occlp, 'SOIL_COLOR': soil_color, \
+                    'FMAX': fmax, 'ORGANIC': organic, 'PCT_SAND': pct_sand, 'PCT_CLAY': pct_clay, \
+                    'PCT_NATVEG': pct_nat_veg, 'PCT_NAT_PFT': pct_pft, \
+                    'MONTHLY_HEIGHT_TOP': monthly_height_top, 'MONTHLY_HEIGHT_BOT': monthly_height_bot, \
+                    'MONTHLY_LAI': monthly_lai})
+        ierr = nffun.putvars(surffile_new, surfvars)
     
     else: # not if(issite)
         if (int(options.mypft) >= 0):
@@ -752,6 +711,7 @@ for n in range(0,n_grids):
 
     surffile_old = surffile_new
 
+nffun.close_all()
 surffile_new = './temp/surfdata.nc'
 
 if (n_grids > 1):
@@ -812,25 +772,15 @@ if (options.nopftdyn == False):
           os.system('ncks -h -O --fix_rec_dmn time -d lsmlon,'+str(xgrid_min[n])+','+str(xgrid_max[n])+ \
                   ' -d lsmlat,'+str(ygrid_min[n])+','+str(ygrid_max[n])+' '+pftdyn_orig+' '+pftdyn_new)
     if (issite):
-        landfrac     = nffun.getvar(pftdyn_new, 'LANDFRAC_PFT')
-        pftdata_mask = nffun.getvar(pftdyn_new, 'PFTDATA_MASK')
-        longxy       = nffun.getvar(pftdyn_new, 'LONGXY')
-        latixy       = nffun.getvar(pftdyn_new, 'LATIXY')
-        area         = nffun.getvar(pftdyn_new, 'AREA')
-        pct_pft      = nffun.getvar(pftdyn_new, 'PCT_NAT_PFT')
-        pct_lake_1850    = nffun.getvar(surffile_new, 'PCT_LAKE')
-        pct_glacier_1850 = nffun.getvar(surffile_new, 'PCT_GLACIER')
-        pct_wetland_1850 = nffun.getvar(surffile_new, 'PCT_WETLAND')
-        pct_urban_1850   = nffun.getvar(surffile_new, 'PCT_URBAN')
-        pct_pft_1850     = nffun.getvar(surffile_new, 'PCT_NAT_PFT')
+        landfrac, pftdata_mask, longxy, latixy, area, pct_pft, grazing, harvest_sh1, harvest_sh2, \
+          harvest_sh3, harvest_vh1, harvest_vh2 = nffun.getvars(pftdyn_new, ['LANDFRAC_PFT', \
+          'PFTDATA_MASK', 'LONGXY', 'LATIXY', 'AREA', 'PCT_NAT_PFT', 'GRAZING', 'HARVEST_SH1', \
+          'HARVEST_SH2', 'HARVEST_SH3', 'HARVEST_VH1', 'HARVEST_VH2'])
+        pct_lake_1850, pct_glacier_1850, pct_wetland_1850, pct_urban_1850, pct_pft_1850 = \
+          nffun.getvars(surffile_new, ['PCT_LAKE', 'PCT_GLACIER', 'PCT_WETLAND', 'PCT_URBAN', \
+          'PCT_NAT_PFT'])
         if (options.mymodel == 'CLM5'):
             pct_crop_1850    = nffun.getvar(surffile_new, 'PCT_CROP')
-        grazing      = nffun.getvar(pftdyn_new, 'GRAZING')
-        harvest_sh1  = nffun.getvar(pftdyn_new, 'HARVEST_SH1')
-        harvest_sh2  = nffun.getvar(pftdyn_new, 'HARVEST_SH2')
-        harvest_sh3  = nffun.getvar(pftdyn_new, 'HARVEST_SH3')
-        harvest_vh1  = nffun.getvar(pftdyn_new, 'HARVEST_VH1')
-        harvest_vh2  = nffun.getvar(pftdyn_new, 'HARVEST_VH2')
         
         #read file for site-specific PFT information
         dynexist = False
@@ -971,20 +921,13 @@ if (options.nopftdyn == False):
                         pct_pft[t][p][0][0] = pct_pft[t][p][0][0]/sumpft*(100.0) #-nonpft)
             
 
-        ierr = nffun.putvar(pftdyn_new, 'LANDFRAC_PFT', landfrac)
-        ierr = nffun.putvar(pftdyn_new, 'PFTDATA_MASK', pftdata_mask)
-        ierr = nffun.putvar(pftdyn_new, 'LONGXY', longxy)
-        ierr = nffun.putvar(pftdyn_new, 'LATIXY', latixy)
-        ierr = nffun.putvar(pftdyn_new, 'AREA', area)
-        ierr = nffun.putvar(pftdyn_new, 'PCT_NAT_PFT', pct_pft)
-        ierr = nffun.putvar(pftdyn_new, 'GRAZING', grazing)
-        ierr = nffun.putvar(pftdyn_new, 'HARVEST_SH1', harvest_sh1)
-        ierr = nffun.putvar(pftdyn_new, 'HARVEST_SH2', harvest_sh2)
-        ierr = nffun.putvar(pftdyn_new, 'HARVEST_SH3', harvest_sh3)
-        ierr = nffun.putvar(pftdyn_new, 'HARVEST_VH1', harvest_vh1)
-        ierr = nffun.putvar(pftdyn_new, 'HARVEST_VH2', harvest_vh2)
+        ierr = nffun.putvars(pftdyn_new, {'LANDFRAC_PFT': landfrac, 'PFTDATA_MASK': pftdata_mask, \
+                    'LONGXY': longxy, 'LATIXY': latixy, 'AREA': area, 'PCT_NAT_PFT': pct_pft, \
+                    'GRAZING': grazing, 'HARVEST_SH1': harvest_sh1, 'HARVEST_SH2': harvest_sh2, \
+                    'HARVEST_SH3': harvest_sh3, 'HARVEST_VH1': harvest_vh1, 'HARVEST_VH2': harvest_vh2})
     pftdyn_old = pftdyn_new
 
+  nffun.close_all()
   pftdyn_new = './temp/surfdata.pftdyn.nc'
   if (os.path.isfile(pftdyn_new)):
       print('Warning:  Removing existing pftdyn data file')
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
-import sys,os, time
+import sys,os, time, threading, json, glob, shutil, csv, re
+import concurrent.futures, multiprocessing
 import numpy as np
 import netcdf4_functions as nffun
+import ensemble_copy
 import subprocess
-from mpi4py import MPI
 from optparse import OptionParser
 
 #MPI python code used to manage the ensemble simulations 
@@ -42,8 +43,46 @@ parser.add_option("--spruce_treatments", dest="spruce_treatments", default=False
                   action='store_true', help = 'Run 11 SPRUCE treatment simulations')
 parser.add_option('--run_uq', dest="run_uq", default=True, action="store_true", \
                   help = 'Run sensitivity analysis using UQTk')
+parser.add_option('--stage_templates', dest="stage_templates", default=False, action="store_true", \
+                  help = 'Stage member netcdf inputs from cached NetCDF3 templates')
+parser.add_option('--link_inputs', dest="link_inputs", default='', \
+                  help = 'Link member inputs not modified by the parameters instead of copying (hard or sym)')
+parser.add_option('--dispatcher_only', dest="dispatcher_only", default=False, action="store_true", \
+                  help = 'Rank 0 only dispatches jobs and collects results (does not run members)')
+parser.add_option('--resume', dest="resume", default=False, action="store_true", \
+                  help = 'Run only members missing or failed in the journal of a previous run')
+parser.add_option('--result_store', dest="result_store", default=False, action="store_true", \
+                  help = 'Write results to a memory-mapped binary store as members complete')
+parser.add_option('--serial_postproc', dest="serial_postproc", default=False, action="store_true", \
+                  help = 'Postprocess each member before starting the next (no overlap with the model run)')
+parser.add_option('--executor', dest="executor", default='mpi', type='choice', choices=['mpi', 'local'], \
+                  help = 'Run members with MPI ranks (mpi) or a pool of local processes (local)')
+parser.add_option('--nworkers', dest="nworkers", default=os.cpu_count(), \
+                  help = 'Number of processes with --executor local')
+parser.add_option('--schedule', dest="schedule", default='index', \
+                  help = 'Dispatch order:  member index (index) or longest expected run time first (cost)')
+parser.add_option('--cost_file', dest="cost_file", default='', \
+                  help = 'Expected cost of each member for --schedule cost (last column, one row per member)')
+parser.add_option('--scratch', dest="scratch", default='', \
+                  help = 'Stage and run members in this node-local directory (e.g. $TMPDIR or /dev/shm)')
+parser.add_option('--keep_restart', dest="keep_restart", default=False, action="store_true", \
+                  help = 'With --scratch, also copy back the last restart file of each member (to start a following case from it)')
+parser.add_option('--prefetch', dest="prefetch", default=1, \
+                  help = 'Number of jobs queued at each worker ahead of the running one')
+parser.add_option('--hierarchical', dest="hierarchical", default=False, action="store_true", \
+                  help = 'Two-level dispatch:  rank 0 sends blocks of jobs to one sub-master rank per node')
+parser.add_option('--block_size', dest="block_size", default=0, \
+                  help = 'Results returned per message by each sub-master with --hierarchical (default ranks per node)')
+parser.add_option('--verify_parms', dest="verify_parms", default=False, action="store_true", \
+                  help = 'Check the parameter manifest of each member against its input files')
+parser.add_option('--max_retries', dest="max_retries", default=1, \
+                  help = 'Number of times a failed member is run again (preferably on another node)')
 
 (options, args) = parser.parse_args()
+#workers change directory while members run and postprocess, so use an absolute runroot
+#  and exeroot
+options.runroot = os.path.abspath(options.runroot)
+options.exeroot = os.path.abspath(options.exeroot)
 
 options.n = int(options.n)
 
@@ -70,80 +109,148 @@ else:
       print('Ensemble file not provided')
       print('Getting parameter information from output files')
 
+def histfile(rundir, case, v, pft, year):
+    #history file, PFT/column index and offset of the SPRUCE hollow for one output line
+    if (pft <= 0 or 'PFT' in v):
+      return rundir+case+'.'+options.model_name+'.h0.'+str(10000+year)[1:]+'-01-01-00000.nc', max(0,pft), 1
+    return rundir+case+'.'+options.model_name+'.h1.'+str(10000+year)[1:]+'-01-01-00000.nc', pft, 17
+
+def history_files(baserundir, case, myvars, myyear_start, myyear_end, mypft, mytreatment):
+    #run directory of each output line, and the variables needed from each history file
+    rundirs = []
+    for index in range(0,len(myvars)):
+        rundirs.append(baserundir)
+        if (mytreatment[index] != 'NA'):
+          rundirs[index] = baserundir+mytreatment[index]+'/'
+    filevars = {}
+    for index in range(0,len(myvars)):
+        v = myvars[index]
+        for y in range(myyear_start[index],myyear_end[index]+1):
+            fname, myindex, hol_add = histfile(rundirs[index], case, v, mypft[index], y)
+            if (not fname in filevars):
+              filevars[fname] = []
+            if (not v in filevars[fname]):
+              filevars[fname].append(v)
+            if ('ZWT' in v and not 'H2OSFC' in filevars[fname]):
+              filevars[fname].append('H2OSFC')
+    return rundirs, filevars
+
 #Define function to perform ensemble member post-processing
 def postproc(myvars, myyear_start, myyear_end, myday_start, myday_end, myavg, \
              myfactor, myoffset, mypft, mytreatment, thisjob, runroot, case, pnames, ppfts, data, parms):
     baserundir = options.runroot+'/UQ/'+case+'/g'+str(100000+thisjob)[1:]+'/'
-    index=0
     ierr = 0
     thiscol = 0
     print(thisjob)
-    for v in myvars:
-        rundir=baserundir
-        if (mytreatment[index] != 'NA'):
-          rundir = rundir+mytreatment[index]+'/'
-        ndays_total = 0
-        output = []
-        n_years = myyear_end[index]-myyear_start[index]+1
-        npy=1
+    #read each history file once, with all of the variables requested from it.  Daily
+    #  files are read over the union of the requested days and PFTs/columns (with the
+    #  hollow for SPRUCE), annual files only for the first time slice.  Masked values
+    #  become NaN.
+    rundirs, filevars = history_files(baserundir, case, myvars, myyear_start, myyear_end, \
+                                      mypft, mytreatment)
+    slabs = {}
+    for index in range(0,len(myvars)):
+        v = myvars[index]
         for y in range(myyear_start[index],myyear_end[index]+1):
-            if (mypft[index] <= 0 or 'PFT' in v):
-              fname = rundir+case+'.'+options.model_name+'.h0.'+str(10000+y)[1:]+'-01-01-00000.nc'
-              myindex = max(0,mypft[index])
-              hol_add = 1
-            else:
-              fname = rundir+case+'.'+options.model_name+'.h1.'+str(10000+y)[1:]+'-01-01-00000.nc'
-              myindex = mypft[index]
-              hol_add = 17
-            if (os.path.exists(fname)):
-              mydata = nffun.getvar(fname,v) 
-              if ('ZWT' in v):
-                mydata2 = nffun.getvar(fname,'H2OSFC')
-              if (len(mydata) < 10):
-                npy = 1 
-              elif (len(mydata) >= 365):    #does not currently allow hourly
-                npy = 365
+            fname, myindex, hol_add = histfile(rundirs[index], case, v, mypft[index], y)
+            cols = [myindex]
+            if ('US-SPR' in case):
+              cols.append(myindex+hol_add)
+            v2s = [v]
+            if ('ZWT' in v):
+              v2s.append('H2OSFC')
+            for v2 in v2s:
+              if (not (fname, v2) in slabs):
+                slabs[(fname, v2)] = [myday_start[index]-1, myday_end[index], set()]
+              slab = slabs[(fname, v2)]
+              slab[0] = min(slab[0], myday_start[index]-1)
+              slab[1] = max(slab[1], myday_end[index])
+              slab[2].update(cols)
+    hist = {}
+    #first day read and position of each column read (None for annual files)
+    hist_t0 = {}
+    hist_cols = {}
+    for fname in filevars:
+        if (os.path.exists(fname)):
+          hist[fname] = {}
+          keys = []
+          for v in filevars[fname]:
+            t0, t1, cols = slabs[(fname, v)]
+            if (nffun.getshape(fname, v)[0] >= 365):     #does not currently allow hourly
+              cols = sorted(cols)
+              hist_t0[(fname, v)] = t0
+              hist_cols[(fname, v)] = dict(zip(cols, range(0,len(cols))))
+              keys.append((cols, (t0, t1)))
             else:
-              #print(fname)
-              mydata = np.zeros([npy,34], float)+np.NaN
-            #get output and average over days/years
-            n_days = myday_end[index]-myday_start[index]+1
-            ndays_total = ndays_total + n_days
-            #get number of timesteps per output file
-            #print(v, n_days, ndays_total)
-        
-            if (npy == 365):
-                for d in range(myday_start[index]-1,myday_end[index]):
-                    if ('US-SPR' in case and 'ZWT' in v):
-                      #Use hollows for water table height
-                      output.append(mydata[d][myindex+hol_add]*myfactor[index] \
-                             +myoffset[index]+mydata2[d][myindex+hol_add]/1000.)
-                    elif ('US-SPR' in case):
-                      output.append(0.25*(mydata[d][myindex+hol_add]*myfactor[index] \
-                             +myoffset[index]) + 0.75*(mydata[d][myindex]*myfactor[index] \
-                             +myoffset[index]))
-                    else:
-                      output.append(mydata[d][myindex]*myfactor[index] \
-                             +myoffset[index])
-            elif (npy == 1):                    #Assume annual output (ignore days)
-               for d in range(myday_start[index]-1,myday_end[index]):    #28-38 was myindex
-                 if ('SCPF' in v):
-                   output.append(sum(mydata[0,28:38])/10.0*myfactor[index]+myoffset[index])
-                 elif ('NPLANT_SCLS' in v):
-                   output.append(sum(mydata[0,1:])*myfactor[index]+myoffset[index])
-                 elif ('SCLS' in v):
-                    output.append(sum(mydata[0,:])*myfactor[index]+myoffset[index])
-                 else:
-                   try:
-                     output.append(mydata[0,myindex]*myfactor[index]+myoffset[index])
-                   except:
-                     output.append(np.NaN)
-        for i in range(0,int(ndays_total/myavg[index])):
-            data[thiscol] = sum(output[(i*myavg[index]):((i+1)*myavg[index])])/myavg[index]
-            thiscol=thiscol+1
-        index=index+1
-
-    #get the parameters
+              hist_t0[(fname, v)] = 0
+              hist_cols[(fname, v)] = None
+              keys.append((None, (0, 1)))
+          myvals = nffun.getvars(fname, filevars[fname], slabs=keys)
+          for i in range(0,len(myvals)):
+            hist[fname][filevars[fname][i]] = np.ma.filled(np.ma.asarray(myvals[i], dtype=float), np.nan)
+
+    for index in range(0,len(myvars)):
+        v = myvars[index]
+        factor = myfactor[index]
+        offset = myoffset[index]
+        n_days = myday_end[index]-myday_start[index]+1
+        output = []
+        for y in range(myyear_start[index],myyear_end[index]+1):
+            fname, myindex, hol_add = histfile(rundirs[index], case, v, mypft[index], y)
+            if (not fname in hist):
+              output.append(np.zeros([n_days], float)+np.nan)
+              continue
+            mydata = hist[fname][v]
+            colpos = hist_cols[(fname, v)]
+            if (colpos is not None):
+                #requested days for the PFT/column (and the hollow for SPRUCE)
+                t0 = hist_t0[(fname, v)]
+                days = slice(myday_start[index]-1-t0, myday_end[index]-t0)
+                if ('US-SPR' in case and 'ZWT' in v):
+                  #Use hollows for water table height
+                  h2osfc = hist[fname]['H2OSFC']
+                  hcol = hist_cols[(fname, 'H2OSFC')][myindex+hol_add]
+                  h0 = hist_t0[(fname, 'H2OSFC')]
+                  output.append(mydata[days,colpos[myindex+hol_add]]*factor+offset \
+                                +h2osfc[myday_start[index]-1-h0:myday_end[index]-h0,hcol]/1000.)
+                elif ('US-SPR' in case):
+                  #25% hollow, 75% hummock
+                  output.append(0.25*(mydata[days,colpos[myindex+hol_add]]*factor+offset) \
+                                +0.75*(mydata[days,colpos[myindex]]*factor+offset))
+                else:
+                  output.append(mydata[days,colpos[myindex]]*factor+offset)
+            else:                    #Assume annual output (ignore days)
+                if ('SCPF' in v):    #28-38 was myindex
+                  myval = np.sum(mydata[0,28:38])/10.0
+                elif ('NPLANT_SCLS' in v):
+                  myval = np.sum(mydata[0,1:])
+                elif ('SCLS' in v):
+                  myval = np.sum(mydata[0,:])
+                else:
+                  try:
+                    myval = mydata[0,myindex]
+                  except IndexError:
+                    myval = np.nan
+                output.append(np.zeros([n_days], float)+(myval*factor+offset))
+        #average over consecutive windows of myavg days
+        output = np.concatenate(output)
+        nwin = int(len(output)/myavg[index])
+        data[thiscol:thiscol+nwin] = output[0:nwin*myavg[index]].reshape(nwin, myavg[index]).mean(axis=1)
+        thiscol = thiscol+nwin
+
+    #get the parameters:  from the manifest written when the member was staged, else
+    #  (and with --verify_parms, to check the manifest) from the member's input files
+    manifest = baserundir+'parm_values_'+str(100000+thisjob)[1:]+'.txt'
+    staged = None
+    if (os.path.exists(manifest) and not options.microbe):
+      mnames, mindices, staged = ensemble_copy.read_manifest(manifest)
+      if (mnames != pnames or mindices != pindices):
+        print('Warning:  '+manifest+' does not match '+options.parm_list+'.  Reading parameters from files')
+        staged = None
+      else:
+        parms[:] = staged
+        if (not options.verify_parms):
+          return ierr
     if (options.microbe):
       pfname =baserundir+'microbepar_in'
       pnum=0
@@ -159,10 +266,11 @@ def postproc(myvars, myyear_start, myyear_end, myday_start, myday_end, myavg, \
       #pfname_def = baserundir+'clm_params.nc'
       fpfname = baserundir+'fates_params_'+str(100000+thisjob)[1:]+'.nc'
       sfname = baserundir+'surfdata_'+str(100000+thisjob)[1:]+'.nc'
+      #member files are NetCDF3 (see ensemble_copy.py), so values are read from memory maps
       pnum=0
       for p in pnames:
          if (p == 'lai'):     #Surface data file
-           mydata = nffun.getvar(sfname,'MONTHLY_LAI')
+           mydata = nffun.getview(sfname,'MONTHLY_LAI')
            parms[pnum] = mydata[0,0,0,0]
          elif (p == 'co2'):   #CO2 value from namelist
            lnd_infile = open(baserundir+'lnd_in','r')
@@ -172,7 +280,7 @@ def postproc(myvars, myyear_start, myyear_end, myday_start, myday_end, myavg, \
            parms[pnum] = ppmv
            lnd_infile.close()
          elif ('fates' in p):   #fates parameter file
-           mydata = nffun.getvar(fpfname,p) 
+           mydata = nffun.getview(fpfname,p)
            if (int(ppfts[pnum]) >= 0):
              if ('fates_prt_nitr_stoich_p1' in p):
                #this is a 2D parameter.
@@ -206,7 +314,7 @@ def postproc(myvars, myyear_start, myyear_end, myday_start, myday_end, myavg, \
              except:
                parms[pnum] = mydata
          else:                #Regular parameter file
-           mydata = nffun.getvar(pfname,p) 
+           mydata = nffun.getview(pfname,p)
            if (int(ppfts[pnum]) > 0):
              if (p == 'psi50'):
                parms[pnum] = mydata[0,int(ppfts[pnum])]
@@ -218,20 +326,45 @@ def postproc(myvars, myyear_start, myyear_end, myday_start, myday_end, myavg, \
              except:
                parms[pnum] = mydata
          pnum=pnum+1
+    if (staged is not None):
+      for pnum in range(0,len(pnames)):
+        if (not np.isclose(parms[pnum], staged[pnum], rtol=1e-6)):
+          print('Warning:  member '+str(thisjob)+' '+pnames[pnum]+' is '+str(parms[pnum])+ \
+                ' in its input files but '+str(staged[pnum])+' in '+manifest)
+      parms[:] = staged
 
     return ierr
             
 
-comm=MPI.COMM_WORLD
-rank=comm.Get_rank()
-size=comm.Get_size()
+if (options.executor == 'mpi'):
+  from mpi4py import MPI
+  comm=MPI.COMM_WORLD
+  rank=comm.Get_rank()
+  size=comm.Get_size()
+  hosts=comm.allgather(MPI.Get_processor_name())
+  if (options.hierarchical):
+    #Rank 0 only dispatches.  The other ranks of each node form a group (gcomm, in rank
+    #  order), and the first of them is the sub-master of the node (see submaster).
+    nodes = sorted(set(hosts[1:]))
+    submasters = [min([r for r in range(1,size) if hosts[r] == h]) for h in nodes]
+    group = []
+    color = MPI.UNDEFINED
+    if (rank > 0):
+      group = [r for r in range(1,size) if hosts[r] == hosts[rank]]
+      color = nodes.index(hosts[rank])
+    gcomm = comm.Split(color, rank)
+else:
+  #local process pool (no MPI):  this process dispatches jobs and collects results
+  rank=0
+  size=1
+  hosts=[os.uname()[1]]
 
 workdir = os.getcwd()
 
-#get postproc info
+#get postproc info (read on rank 0 and broadcast, so large runs do not all open the file)
 do_postproc=False
-if (os.path.isfile(options.postproc_file)):
-    do_postproc=True
+postproc_spec = None
+if (rank == 0 and os.path.isfile(options.postproc_file)):
     myvars=[]
     myyear_start=[]
     myyear_end=[]
@@ -244,7 +377,6 @@ if (os.path.isfile(options.postproc_file)):
     myobs=[]
     myobs_err=[]
     mytreatment=[]
-    time.sleep(rank*0.2)
     postproc_input = open(options.postproc_file,'r')
     data_cols = 0
     for s in postproc_input:
@@ -275,14 +407,20 @@ if (os.path.isfile(options.postproc_file)):
             data_cols = int(round(data_cols + days_total / int(s.split()[5])))
             print('DATA_COLS',data_cols)
     print(mytreatment)
-    if (rank == 0):
-        data = np.zeros([data_cols,options.n], float)-999
-    data_row = np.zeros([data_cols], float)-999
     postproc_input.close()
+    postproc_spec = (myvars, myyear_start, myyear_end, myday_start, myday_end, myavg_pd, myfactor, \
+                     myoffset, mypft, myobs, myobs_err, mytreatment, data_cols)
+if (options.executor == 'mpi'):
+    postproc_spec = comm.bcast(postproc_spec, root=0)
+if (postproc_spec is not None):
+    do_postproc=True
+    (myvars, myyear_start, myyear_end, myday_start, myday_end, myavg_pd, myfactor, \
+         myoffset, mypft, myobs, myobs_err, mytreatment, data_cols) = postproc_spec
 
 #get the parameter names
 pnames=[]
 ppfts=[]
+pindices=[]     #PFT indices as ints (-1 without one), as in ensemble_copy.read_parm_list
 pmin=[]
 pmax=[]
 pfile = open(options.parm_list,'r')
@@ -290,59 +428,840 @@ nparms = 0
 for s in pfile:
   pnames.append(s.split()[0])
   ppfts.append(s.split()[1])
+  if (len(s.split()) == 3):
+    pindices.append(-1)
+  else:
+    pindices.append(int(s.split()[1]))
   pmin.append(s.split()[2])
   pmax.append(s.split()[3])
   nparms = nparms+1
 pfile.close()
-parm_row = np.zeros([nparms], float)-999
+#Each member's results travel as one float64 row, the postprocessed outputs
+#  (data_cols) followed by the parameter values, the member's telemetry (from tcol),
+#  its run time (s) and its failure code (0 = good, see failure_reasons), received by
+#  rank 0 straight into results
+if (not do_postproc):
+  data_cols = 0
+tcol = data_cols+nparms
+telemetry_names = ['stage_time', 'model_time', 'postproc_time', 'max_rss_mb']
+ncols = data_cols+nparms+len(telemetry_names)+2
+result_row = np.zeros([ncols], float)-999
 if (rank == 0):
-  parms = np.zeros([nparms, options.n],float)-999
+  if (options.result_store):
+    #Binary result store UQ_output/<case>/results.npy (member x [outputs, parameters]),
+    #  memory-mapped so rows are written to disk as members complete, with names and
+    #  column layout in results.json.  Readable during the run with np.load(mmap_mode='r').
+    store_dir = workdir+'/UQ_output/'+options.casename
+    os.system('mkdir -p '+store_dir)
+    store_file = store_dir+'/results.npy'
+    results = None
+    #rows of a previous run are only in the store if it could be reopened
+    store_reopened = False
+    if (options.resume and os.path.exists(store_file)):
+      results = np.load(store_file, mmap_mode='r+')
+      if (results.shape != (options.n, ncols)):
+        print('Warning:  '+store_file+' does not match this ensemble.  Starting a new store')
+        results = None
+      else:
+        store_reopened = True
+    if (results is None):
+      results = np.lib.format.open_memmap(store_file, mode='w+', dtype=float, \
+                                          shape=(options.n, ncols))
+      results[:,:] = -999
+    store_info = {'case': options.casename, 'n_ensemble': options.n, 'data_cols': data_cols, \
+                  'nparms': nparms, 'columns': 'postprocessed outputs [0:data_cols], then parameters, telemetry, run time (s) and failure code', \
+                  'telemetry': telemetry_names, 'parm_names': pnames, 'parm_pfts': ppfts, 'parm_min': pmin, 'parm_max': pmax}
+    if (do_postproc):
+      store_info.update({'output_vars': myvars, 'year_start': myyear_start, 'year_end': myyear_end, \
+                         'day_start': myday_start, 'day_end': myday_end, 'avg_days': myavg_pd, \
+                         'pft': mypft, 'treatment': mytreatment, 'obs': myobs, 'obs_err': myobs_err})
+    myoutput = open(store_dir+'/results.json', 'w')
+    json.dump(store_info, myoutput, indent=1)
+    myoutput.close()
+  else:
+    results = np.zeros([options.n, ncols], float)-999
   sse_ensemble = np.zeros([options.n], float)-999      
 
 niter = 1
 
+#--------------------- Worker (individual ensemble members) ---------------------
+#Failure codes reported in the last column of a member's result row
+failure_reasons = {1: 'model exited with an error', 2: 'error in model log', \
+                   3: 'history files missing', 4: 'postprocessing failed or NaN outputs', \
+                   5: 'error staging, running or copying back the member'}
+#Messages in the end of a model log that mean the run aborted (regular expressions,
+#  ERROR only as an "ERROR:" message at the start of a line)
+log_errors = [r'^\s*ERROR:', r'\bENDRUN\b', 'SIGSEGV', 'Segmentation fault', 'forrtl: severe', \
+              'MPI_Abort', 'MPI_ABORT']
+log_errors_re = [re.compile(e, re.MULTILINE) for e in log_errors]
+
+def check_run(case, rundir, ierr, logs, histdir=None):
+  #Failure code of a finished run of the member in rundir (0 if it looks good):  the
+  #  exit status of the executable, the last 8 kB of each of its logs (paths) and the
+  #  member's history files, or only those in histdir
+  if (ierr != 0):
+    return 1
+  for log in logs:
+    if (os.path.exists(log)):
+      myinput = open(log, 'rb')
+      myinput.seek(0, 2)
+      myinput.seek(max(0, myinput.tell()-8192))
+      tail = myinput.read().decode(errors='replace')
+      myinput.close()
+      for e in log_errors_re:
+        if (e.search(tail)):
+          print('Member run in '+rundir+' failed:  '+e.pattern+' in '+log)
+          return 2
+  if (do_postproc):
+    rundirs, filevars = history_files(rundir, case, myvars, myyear_start, myyear_end, \
+                                      mypft, mytreatment)
+    for fname in filevars:
+      if ((histdir is None or os.path.dirname(fname)+'/' == histdir) and not os.path.exists(fname)):
+        print('Member run in '+rundir+' failed:  missing '+fname)
+        return 3
+  elif (len(glob.glob((histdir or rundir)+'*.'+options.model_name+'.h0.*.nc')) == 0):
+    print('Member run in '+rundir+' failed:  no history files')
+    return 3
+  return 0
+
+#SPRUCE treatments (--spruce_treatments), run from each member's 2015 restart
+treatments=['TAMB','T0.00','T2.25','T4.50','T6.75','T9.00', \
+            'T0.00CO2','T2.25CO2','T4.50CO2','T6.75CO2','T9.00CO2']
+plots=[7,6,20,13,8,17,19,11,4,16,10]
+#Each member is one task (the member number) that is staged, run and postprocessed.
+#  With --spruce_treatments the member is split into tasks member+100000*step:  the
+#  base run (step 0), one per treatment (steps 1-11) once the base run has made the
+#  2015 restart, and postprocessing (last_step) once all treatments are done, so the
+#  treatments of a member run on any idle workers.  With --scratch the restart is not
+#  visible to other nodes, and the treatments run in the base run task instead.
+fanout = (options.spruce_treatments and options.scratch == '' and not options.postproc_only)
+last_step = 0
+if (fanout):
+  last_step = len(treatments)+1
+
+def task_member(task):
+  return task % 100000
+
+def task_step(task):
+  return task // 100000
+
+def task_name(task):
+  step = task_step(task)
+  if (step == 0):
+    return 'run'
+  elif (step == last_step):
+    return 'postproc'
+  return treatments[step-1]
+
+def run_model(exe, log, result_row):
+  #Run the model executable in the current directory with its output to log.  The
+  #  wall time and peak resident memory (from the rusage of the finished process) are
+  #  added to the telemetry in result_row.  Returns the exit status.
+  t0 = time.time()
+  myoutput = open(log, 'w')
+  pid = os.posix_spawn(exe, [exe], os.environ, file_actions=[(os.POSIX_SPAWN_DUP2, myoutput.fileno(), 1)])
+  myoutput.close()
+  pid, status, rusage = os.wait4(pid, 0)
+  result_row[tcol+1] += time.time()-t0
+  result_row[tcol+3] = max(result_row[tcol+3], rusage.ru_maxrss/1024.0)
+  return os.waitstatus_to_exitcode(status)
+
+def run_treatment(case, myjob, t, rundir, result_row):
+  #Run treatment t of a member from the 2015 restart of its base run in rundir.  The
+  #  run is made in rundir/<treatment>/ with its own namelists, so treatments of a
+  #  member can run at the same time.  Returns the failure code of the run.
+  tdir = rundir+treatments[t]+'/'
+  os.system('mkdir -p '+tdir+'timing/checkpoints')
+  pst = str(100+plots[t])[1:]
+  for f in os.listdir(rundir):
+    if (not os.path.isfile(rundir+f) or f[-3:] == '.nc' or 'log' in f):
+      continue
+    if (not (f in ['lnd_in', 'drv_in'] or f[-12:] == '_modelio.nml')):
+      shutil.copyfile(rundir+f, tdir+f)
+      continue
+    myinput = open(rundir+f, 'r')
+    myoutput = open(tdir+f, 'w')
+    for s in myinput:
+      if (f == 'lnd_in' and 'finidat =' in s):
+        myoutput.write(" finidat = '"+rundir+case+"."+options.model_name+".r.2015-01-01-00000.nc'\n")
+      elif (f == 'lnd_in' and 'metdata_bypass' in s):
+        myoutput.write(s[:-2]+'/plot'+pst+"'\n")
+        if ('CO2' in treatments[t]):
+          myoutput.write(' add_co2 = 500\n')
+          myoutput.write(" startdate_add_co2 = '20160315'\n")
+      elif (f == 'lnd_in' and 'landuse_timeseries' in s):
+        myoutput.write(s.replace('plot07','plot'+pst))
+      elif (f == 'drv_in' and 'stop_n' in s):
+        myoutput.write(' stop_n = 7\n')
+      elif (f == 'drv_in' and 'restart_n' in s):
+        myoutput.write(' restart_n = 7\n')
+      elif (f == 'drv_in' and 'start_ymd' in s):
+        myoutput.write(' start_ymd = 20150101\n')
+      elif (f[-12:] == '_modelio.nml' and 'diro' in s):
+        #component logs go to the treatment directory
+        myoutput.write('   diro = "'+tdir[:-1]+'"\n')
+      else:
+        myoutput.write(s)
+    myinput.close()
+    myoutput.close()
+  #history of the base run (the treatment run replaces the years from 2015)
+  for fname in glob.glob(rundir+'*.'+options.model_name+'.h?.20[1-2]*.nc'):
+    shutil.copyfile(fname, tdir+os.path.basename(fname))
+  os.chdir(tdir)
+  ierr = run_model(options.exeroot+'/e3sm.exe', 'e3sm_log.txt', result_row)
+  os.chdir(workdir)
+  return check_run(case, rundir, ierr, [tdir+'e3sm_log.txt'], histdir=tdir)
+
+def run_member(task, result_row):
+  #Run one task of a member (see fanout above; nothing to do with --postproc_only),
+  #  with its staging and model telemetry in result_row.  Returns the failure code of
+  #  the run (see check_run).
+  failure = 0
+  myjob = task_member(task)
+  step = task_step(task)
+  if (options.postproc_only == False and (step < last_step or not fanout)):
+      mycases=[]
+      mycases.append(options.casename)
+      for c in mycases:
+        os.chdir(workdir)
+        jobst = str(100000+int(myjob))
+        if (step > 0):
+          failure = max(failure, run_treatment(c, myjob, step-1, options.runroot+'/UQ/'+c+'/g'+jobst[1:]+'/', \
+                                               result_row))
+          continue
+        #with --scratch the member is staged and run there, then copied back
+        ens_root = options.runroot
+        if (options.scratch != ''):
+          ens_root = os.path.abspath(os.path.expandvars(options.scratch))
+        #Set up the ensemble run directory and manipulate parameters (see ensemble_copy.py)
+        t0 = time.time()
+        ensemble_copy.stage_member(c, myjob, ens_values[myjob-1], parm_names, parm_indices, \
+              runroot=options.runroot, model_name=options.model_name, \
+              stage_templates=options.stage_templates, link_inputs=options.link_inputs, \
+              ens_root=ens_root)
+        result_row[tcol] += time.time()-t0
+        rundir = ens_root+'/UQ/'+c+'/g'+jobst[1:]+'/'
+        os.chdir(rundir)
+        #Run the executable
+        exedir = options.exeroot
+        ierr = 0
+        logs = []
+        if os.path.isfile(exedir+'/acme.exe'):
+           ierr = run_model(exedir+'/acme.exe', 'acme_log.txt', result_row)
+           logs.append(rundir+'acme_log.txt')
+        elif os.path.isfile(exedir+'/e3sm.exe'):
+           ierr = run_model(exedir+'/e3sm.exe', 'e3sm_log.txt', result_row)
+           logs.append(rundir+'e3sm_log.txt')
+        elif os.path.isfile(exedir+'/cesm.exe'):
+           ierr = run_model(exedir+'/cesm.exe', 'cesm_log.txt', result_row)
+           logs.append(rundir+'cesm_log.txt')
+        if (options.spruce_treatments):
+          #Transient/SP case should be set up produce 2015 restart file.  The treatments
+          #  are run from it in subdirectories, here or (fanout) as separate tasks.
+          failure = max(failure, check_run(c, rundir, ierr, logs, histdir=rundir))
+          if (not fanout):
+            for t in range(0,len(treatments)):
+              failure = max(failure, run_treatment(c, myjob, t, rundir, result_row))
+        else:
+          failure = max(failure, check_run(c, rundir, ierr, logs))
+        if (options.scratch != ''):
+          copy_back(c, myjob, rundir, options.runroot+'/UQ/'+c+'/g'+jobst[1:]+'/')
+  return failure
+
+def run_checked(task, result_row):
+  #run_member, with any error raised while staging, running or copying back as code 5.
+  #  With --scratch, the member directory there is removed even if the run failed.
+  result_row[tcol:tcol+len(telemetry_names)] = 0
+  try:
+    return run_member(task, result_row)
+  except Exception as e:
+    print('Error running member '+str(task_member(task))+' (task '+str(task)+'): '+str(e))
+    os.chdir(workdir)
+    return 5
+  finally:
+    if (options.scratch != '' and task_step(task) == 0):
+      scratch_dir = os.path.abspath(os.path.expandvars(options.scratch))+'/UQ/'+options.casename+ \
+                    '/g'+str(100000+task_member(task))[1:]
+      if (os.path.exists(scratch_dir)):
+        os.chdir(workdir)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def copy_back(case, myjob, scratch_dir, rundir):
+  #Copy a member run in scratch back to rundir in runroot/UQ:  namelists, logs and the
+  #  member's input files and parameter manifest (read by postproc), only the history variables in the postproc
+  #  spec (all history files without one) and, with --keep_restart, the last restart
+  #  (needed to chain a following case, e.g. 1850 to 20TR, from this one).  Paths in the
+  #  namelists are changed to rundir.  The scratch directory is then removed.
+  os.chdir(workdir)
+  jobst = str(100000+int(myjob))
+  if (not os.path.exists(rundir)):
+    os.makedirs(rundir)
+  for f in os.listdir(scratch_dir):
+    if (os.path.isfile(scratch_dir+f) and (f[-2:] == 'in' or f[-3:] == 'nml')):
+      #namelists point at the member directory in scratch, which is removed below
+      myinput = open(scratch_dir+f, 'r')
+      myoutput = open(rundir+f, 'w')
+      myoutput.write(myinput.read().replace(scratch_dir[:-1], rundir[:-1]))
+      myinput.close()
+      myoutput.close()
+    elif (os.path.isfile(scratch_dir+f) and ('log' in f or f.endswith('_'+jobst[1:]+'.nc') \
+                                          or f.endswith('_'+jobst[1:]+'.txt'))):
+      shutil.copyfile(scratch_dir+f, rundir+f)
+  if (do_postproc):
+    rundirs, filevars = history_files(scratch_dir, case, myvars, myyear_start, myyear_end, \
+                                      mypft, mytreatment)
+    for fname in filevars:
+      if (os.path.exists(fname)):
+        fname_out = rundir+fname[len(scratch_dir):]
+        if (not os.path.exists(os.path.dirname(fname_out))):
+          os.makedirs(os.path.dirname(fname_out))
+        nffun.copyvars(fname, fname_out, filevars[fname])
+        nffun.close_all(fname)
+  else:
+    for fname in glob.glob(scratch_dir+'**/*.'+options.model_name+'.h?.*.nc', recursive=True):
+      fname_out = rundir+fname[len(scratch_dir):]
+      if (not os.path.exists(os.path.dirname(fname_out))):
+        os.makedirs(os.path.dirname(fname_out))
+      shutil.copyfile(fname, fname_out)
+  if (options.keep_restart):
+    restarts = sorted(glob.glob(scratch_dir+'*.'+options.model_name+'.r.*.nc'))
+    if (len(restarts) > 0):
+      shutil.copyfile(restarts[-1], rundir+os.path.basename(restarts[-1]))
+  shutil.rmtree(scratch_dir)
+
+def postprocess(task, result_row, failure):
+  #Postprocess a finished member into result_row (after its last task), with the failure
+  #  code of the task in the last column.  A member that cannot be postprocessed gets
+  #  NaN outputs (code 4).
+  myjob = task_member(task)
+  t0 = time.time()
+  if (do_postproc and task_step(task) == last_step):
+    try:
+      ierr = postproc(myvars, myyear_start, myyear_end, myday_start, \
+                     myday_end, myavg_pd, myfactor, myoffset, mypft, mytreatment, myjob, \
+                     options.runroot, options.casename, pnames, ppfts, result_row[0:data_cols], \
+                     result_row[data_cols:data_cols+nparms])
+    except Exception as e:
+      print('Error postprocessing member '+str(myjob)+': '+str(e))
+      result_row[0:data_cols] = np.nan
+    if (failure == 0 and np.isnan(sum(result_row[0:data_cols]))):
+      failure = 4
+  result_row[tcol+2] = time.time()-t0
+  result_row[-1] = failure
+
+def local_job(task):
+  #Run and postprocess one task in a process of the local pool (--executor local).
+  #  Returns the result row and the process id, for the telemetry.
+  result_row = np.zeros([ncols], float)-999
+  t0 = time.time()
+  failure = run_checked(task, result_row)
+  result_row[-2] = time.time()-t0
+  postprocess(task, result_row, failure)
+  return result_row, os.getpid()
+
+def report(task, result_row, runtime, failure, wcomm):
+  #Postprocess a finished task and send its results to the dispatcher (rank 0 of wcomm)
+  result_row[-2] = runtime
+  postprocess(task, result_row, failure)
+  wcomm.Send([result_row, MPI.DOUBLE], dest=0, tag=3)
+
+def worker(result_row, wcomm):
+  #Run the jobs sent by rank 0 of wcomm until it sends -1.  Used by the worker ranks and
+  #  by a thread on the dispatcher itself:  rank 0 of MPI.COMM_WORLD, or with
+  #  --hierarchical the sub-master of the node.  Unless --serial_postproc, each member is postprocessed
+  #  and reported by a background thread while the next one is staged and run (this
+  #  needs --prefetch >= 1 so the next job is on hand, and MPI_THREAD_MULTIPLE).
+  pipeline = (do_postproc and not options.postproc_only and not options.serial_postproc \
+              and MPI.Query_thread() == MPI.THREAD_MULTIPLE)
+  reporter = None
+  for thisiter in range(0,niter):
+    myjob = wcomm.recv(source=0, tag=1)
+    while (myjob > 0):
+        #post the receive for the next job now; with --prefetch it is already on its way
+        nextjob = wcomm.irecv(source=0, tag=1)
+        if (pipeline):
+            row = np.zeros([ncols], float)-999
+        else:
+            row = result_row
+        t0 = time.time()
+        failure = run_checked(myjob, row)
+        runtime = time.time()-t0
+        #results are reported in job order:  wait for the previous member first
+        if (reporter is not None):
+            reporter.join()
+        if (pipeline):
+            reporter = threading.Thread(target=report, args=(myjob, row, runtime, failure, wcomm))
+            reporter.start()
+        else:
+            report(myjob, row, runtime, failure, wcomm)
+        myjob = nextjob.wait()
+  if (reporter is not None):
+    reporter.join()
+
+def submaster(gcomm):
+  #Second level of --hierarchical dispatch, on one node.  Blocks of jobs from rank 0
+  #  are run on the ranks of the node (gcomm), and on this rank in a worker thread,
+  #  with the same one-job protocol rank 0 uses.  Results go back to rank 0 in one
+  #  message of block_size rows, [job, rank, result row], or sooner when no job is
+  #  queued or running on the node any more.  [-1] from rank 0 stops the node.
+  gsize = gcomm.Get_size()
+  block = int(options.block_size)
+  if (block <= 0):
+    block = gsize
+  first_local = 1
+  if (not options.dispatcher_only and MPI.Query_thread() == MPI.THREAD_MULTIPLE):
+    local_worker = threading.Thread(target=worker, args=(np.zeros([ncols], float)-999, gcomm))
+    local_worker.start()
+    first_local = 0
+  elif (gsize == 1):
+    print('Error:  MPI library does not support MPI_THREAD_MULTIPLE; --hierarchical needs '+ \
+          '2 or more ranks on each node besides rank 0')
+    comm.Abort(1)
+  pending = []
+  queued = [[] for w in range(0,gsize)]
+  rows = []
+  stop = False
+  status = MPI.Status()
+  def fill():
+    for d in range(0,1+int(options.prefetch)):
+      for w in range(first_local,gsize):
+        if (len(queued[w]) <= d and len(pending) > 0):
+          gcomm.send(pending[0], dest=w, tag=1)
+          queued[w].append(pending.pop(0))
+  while (not stop):
+    if (comm.Iprobe(source=0, tag=4)):
+      tasks = comm.recv(source=0, tag=4)
+      if (tasks == [-1]):
+        stop = True
+      else:
+        pending.extend(tasks)
+        fill()
+    elif (gcomm.Iprobe(source=MPI.ANY_SOURCE, tag=3, status=status)):
+      w = status.Get_source()
+      row = np.zeros([ncols+2], float)
+      row[0] = queued[w].pop(0)
+      row[1] = group[w]
+      gcomm.Recv([row[2:], MPI.DOUBLE], source=w, tag=3)
+      rows.append(row)
+      fill()
+      if (len(rows) >= block or all(len(queued[w]) == 0 for w in range(first_local,gsize))):
+        comm.Send([np.array(rows), MPI.DOUBLE], dest=0, tag=5)
+        rows = []
+    else:
+      time.sleep(0.001)
+  for w in range(first_local,gsize):
+    gcomm.send(-1, dest=w, tag=1)
+  if (first_local == 0):
+    local_worker.join()
+
+
+if (options.postproc_only == False):
+  #parameter list and samples are read once and members are staged in-process
+  parm_names, parm_indices = ensemble_copy.read_parm_list(options.parm_list)
+  ens_values = ensemble_copy.read_ens_file(options.ens_file)
+
+def expected_cost():
+  #Expected run time of each member for --schedule cost:  the last column of
+  #  --cost_file, or a least-squares fit of the run times of completed members
+  #  (run time column of results) on their parameter values.  None if not available yet.
+  if (options.cost_file != ''):
+    return np.array([row[-1] for row in ensemble_copy.read_ens_file(options.cost_file)])
+  if (options.postproc_only):
+    return None
+  A = np.hstack((np.ones([options.n,1]), np.array(ens_values)[0:options.n,:]))
+  timed = np.where((results[:,-2] > 0) & (results[:,-1] == 0))[0]
+  if (len(timed) <= A.shape[1]):
+    return None
+  coef = np.linalg.lstsq(A[timed,:], results[timed,-2], rcond=None)[0]
+  return A.dot(coef)
+
+def schedule(jobs, start, n_done):
+  #With --schedule cost, order the jobs not yet dispatched (jobs[start:]) longest
+  #  expected run time first.  The fitted model is updated once nparms+2 members have
+  #  completed in this run, then each time that number doubles.
+  global next_fit
+  if (options.schedule != 'cost'):
+    return
+  if (n_done == 0):
+    next_fit = nparms+2
+  elif (n_done < next_fit or options.cost_file != ''):
+    return
+  else:
+    next_fit = 2*next_fit
+  cost = expected_cost()
+  if (cost is not None):
+    #a member's treatment and postprocessing tasks stay ahead of new members
+    jobs[start:] = sorted(jobs[start:], key=lambda j: (task_step(j) == 0, -cost[task_member(j)-1]))
+
 if (rank == 0):
 
     #--------------------------Perform the model simulations---------------------
-    for thisiter in range(0,niter):
+    #Unless --dispatcher_only, rank 0 also runs members in a worker thread that
+    #  receives jobs from the dispatcher like any other rank (needs MPI_THREAD_MULTIPLE)
+    first_worker = 1
+    if (options.executor == 'mpi' and options.hierarchical):
+      if (size == 1):
+        print('Error:  --hierarchical needs 2 or more ranks')
+        sys.exit(1)
+    elif (options.executor == 'mpi' and not options.dispatcher_only):
+      if (MPI.Query_thread() == MPI.THREAD_MULTIPLE):
+        local_row = np.zeros([ncols], float)-999
+        local_worker = threading.Thread(target=worker, args=(local_row, comm))
+        local_worker.start()
+        first_worker = 0
+      elif (size == 1):
+        print('Error:  MPI library does not support MPI_THREAD_MULTIPLE; run with 2 or more ranks')
+        sys.exit(1)
+    #Append-only journal of completed members (job number and result row per line,
+    #  or only the job number with --result_store, which holds the rows).  With
+    #  --resume, members already in the journal with valid (non-NaN) results are not
+    #  run again and their rows are merged into results.
+    journal_file = workdir+'/'+options.casename+'_journal.txt'
+    done = np.zeros([options.n], bool)
+    def member_done(thisjob):
+      #valid results:  failure code 0 and, when postprocessing (which fills the outputs
+      #  and parameters), no NaN outputs and no -999 left from initialization
+      row = results[thisjob-1]
+      if (row[-1] != 0):
+        return False
+      if (do_postproc):
+        return (not np.isnan(sum(row[0:data_cols])) and not np.any(row[0:tcol] == -999))
+      return True
+    if (options.resume and os.path.exists(journal_file)):
+      myinput = open(journal_file, 'r')
+      for s in myinput:
+        row = s.split()
+        #skip a line left incomplete by an interrupted run
+        if (s[-1:] == '\n' and len(row) == ncols+1):
+          thisjob = int(row[0])
+          results[thisjob-1,:] = [float(v) for v in row[1:]]
+          done[thisjob-1] = member_done(thisjob)
+        elif (s[-1:] == '\n' and len(row) == 1 and options.result_store and store_reopened):
+          thisjob = int(row[0])
+          done[thisjob-1] = member_done(thisjob)
+      myinput.close()
+      print('Resuming: '+str(sum(done))+' of '+str(options.n)+' members already complete')
+      journal = open(journal_file, 'a')
+    else:
+      journal = open(journal_file, 'w')
+    jobs = [j for j in range(1,options.n+1) if not done[j-1]]
+    def record(thisjob):
+      progress['members_done'] += 1
+      if (options.result_store):
+        journal.write(str(thisjob)+'\n')
+      else:
+        journal.write(str(thisjob)+' '+' '.join(['%.17g' % v for v in results[thisjob-1]])+'\n')
+      journal.flush()
+    #A task that fails (nonzero failure code in its row) is queued again at the end
+    #  of jobs up to --max_retries times; the member is then recorded with NaN outputs.
+    #  Each failed attempt is listed in the failure report.
+    failure_file = workdir+'/'+options.casename+'_failures.txt'
+    if (options.resume and os.path.exists(failure_file)):
+      failures = open(failure_file, 'a')
+    else:
+      failures = open(failure_file, 'w')
+      failures.write('#member task attempt rank host code reason\n')
+    attempts = {}
+    failed_on = {}
+    lost = []
+    def retry(task, row, process):
+      #Check the row of a finished task.  Returns True if it failed and was queued again.
+      code = int(row[-1])
+      if (code == 0):
+        return False
+      attempts[task] = attempts.get(task, 0)+1
+      name = task_name(task)
+      failures.write('%d %s %d %d %s %d %s\n'%(task_member(task), name, attempts[task], process, \
+                     hosts[process], code, failure_reasons.get(code, 'unknown')))
+      failures.flush()
+      if (attempts[task] <= int(options.max_retries)):
+        print('Member '+str(task_member(task))+' ('+name+') failed ('+failure_reasons.get(code, 'unknown')+ \
+              '), running it again')
+        failed_on[task] = process
+        jobs.append(task)
+        return True
+      print('Member '+str(task_member(task))+' ('+name+') failed ('+failure_reasons.get(code, 'unknown')+ \
+            ') after '+str(attempts[task])+' attempts')
+      return False
+    def prefer_other(jobs, start, process):
+      #Move the first job from start on that did not last fail on the node of process
+      #  (or failing that, on process itself) to jobs[start]
+      for avoid in [lambda j: hosts[failed_on[j]] == hosts[process], lambda j: failed_on[j] == process]:
+        for i in range(start, len(jobs)):
+          if (not jobs[i] in failed_on or not avoid(jobs[i])):
+            jobs[start], jobs[i] = jobs[i], jobs[start]
+            return
+    #Rows of a member's earlier tasks (fanout) only carry their telemetry, run time and
+    #  failure code, which are added to the row of its last task in results
+    task_row = np.zeros([ncols], float)-999
+    task_stats = {}
+    treatments_left = {}
+    def add_stats(stats, row):
+      #telemetry and run time of a member's tasks:  times add up, memory is the peak
+      if (stats is None):
+        return row[tcol:-1].copy()
+      rss = max(stats[3], row[tcol+3])
+      stats = stats+row[tcol:-1]
+      stats[3] = rss
+      return stats
+    def row_for(task):
+      if (task_step(task) == last_step):
+        return results[task_member(task)-1]
+      return task_row
+    def finished(task, row, process):
+      #Handle the row of a finished task:  queue the task again if it failed, or else the
+      #  member's next tasks (its treatments after the base run, then postprocessing),
+      #  and record members that are done.  New tasks go first in the undispatched jobs.
+      myjob = task_member(task)
+      step = task_step(task)
+      if (myjob in lost or retry(task, row, process)):
+        return
+      if (row[-1] != 0):
+        results[myjob-1,0:data_cols] = np.nan
+        results[myjob-1,-1] = row[-1]
+        jobs[next_job:] = [j for j in jobs[next_job:] if task_member(j) != myjob]
+        lost.append(myjob)
+        record(myjob)
+      elif (step == last_step):
+        if (myjob in task_stats):
+          results[myjob-1,tcol:-1] = add_stats(task_stats.pop(myjob), results[myjob-1])
+        record(myjob)
+      else:
+        task_stats[myjob] = add_stats(task_stats.get(myjob), row)
+        if (step == 0):
+          treatments_left[myjob] = len(treatments)
+          jobs[next_job:next_job] = [myjob+100000*(t+1) for t in range(0,len(treatments))]
+        else:
+          treatments_left[myjob] -= 1
+          if (treatments_left[myjob] == 0):
+            jobs[next_job:next_job] = [myjob+100000*last_step]
+    #Telemetry:  a line for each finished task in <case>_telemetry.csv, and the progress
+    #  of the ensemble (throughput, ETA, mean times and the fraction of the time rank 0
+    #  is busy handling results) in <case>_progress.json, rewritten at most once a second
+    telemetry_file = workdir+'/'+options.casename+'_telemetry.csv'
+    new_telemetry = not (options.resume and os.path.exists(telemetry_file))
+    telemetry = open(telemetry_file, 'a')
+    telemetry_out = csv.writer(telemetry)
+    if (new_telemetry):
+      telemetry_out.writerow(['member', 'task', 'rank', 'host', 'finish_time']+telemetry_names+ \
+                             ['run_time', 'failure_code'])
+    progress_file = workdir+'/'+options.casename+'_progress.json'
+    progress = {'t_start': time.time(), 't_written': 0.0, 't_printed': time.time(), \
+                'tasks_done': 0, 'members_done': int(sum(done)), 'members_resumed': int(sum(done)), \
+                'busy': 0.0, 'totals': np.zeros([len(telemetry_names)+1], float), 'tasks_timed': 0}
+    def log_task(task, row, process, host=None):
+      #add a finished task (before finished() handles its row) to the telemetry.  process
+      #  is the MPI rank, or the process id with the local pool (then give the host).
+      #  Tasks without telemetry (NaN, a local job that raised) are left out of the means.
+      elapsed = time.time()-progress['t_start']
+      if (host is None):
+        host = hosts[process]
+      telemetry_out.writerow([task_member(task), task_name(task), process, host, '%.3f' % elapsed]+ \
+                             ['%.3f' % v for v in row[tcol:-1]]+[int(row[-1])])
+      progress['tasks_done'] += 1
+      if (not np.any(np.isnan(row[tcol:-1]))):
+        progress['tasks_timed'] += 1
+        progress['totals'] += row[tcol:-1]
+    def write_progress(final=False):
+      #rewrite the progress file (and print a progress line at most once a minute)
+      now = time.time()
+      if (not final and now-progress['t_written'] < 1.0):
+        return
+      progress['t_written'] = now
+      telemetry.flush()
+      elapsed = now-progress['t_start']
+      members_run = progress['members_done']-progress['members_resumed']
+      throughput = members_run/max(elapsed, 1e-9)
+      eta = None
+      if (throughput > 0):
+        eta = (options.n-progress['members_done'])/throughput
+      means = progress['totals']/max(progress['tasks_timed'], 1)
+      info = {'case': options.casename, 'elapsed': elapsed, 'members_total': options.n, \
+              'members_done': progress['members_done'], 'members_failed': len(lost), \
+              'tasks_done': progress['tasks_done'], 'tasks_queued': len(jobs)-progress['tasks_done'], \
+              'throughput_members_per_hour': 3600.0*throughput, 'eta_seconds': eta, \
+              'dispatcher_busy_fraction': progress['busy']/max(elapsed, 1e-9), 'finished': final}
+      for i in range(0,len(telemetry_names)):
+        info['mean_'+telemetry_names[i]] = means[i]
+      info['mean_run_time'] = means[-1]
+      myoutput = open(progress_file+'_tmp', 'w')
+      json.dump(info, myoutput, indent=1)
+      myoutput.close()
+      os.rename(progress_file+'_tmp', progress_file)
+      if (final or now-progress['t_printed'] >= 60.0):
+        progress['t_printed'] = now
+        line = 'Progress:  '+str(progress['members_done'])+' of '+str(options.n)+' members, '+ \
+               '%.1f members/h' % (3600.0*throughput)
+        if (eta is not None and not final):
+          line = line+', ETA %.0f s' % eta
+        print(line)
+    if (options.executor == 'local'):
+      #Pool of forked local processes:  jobs are submitted in dispatch order and each
+      #  returns its result row.  The processes report their netCDF I/O statistics
+      #  (OLMT_NCSTATS) when the pool shuts down.
+      #  Up to two jobs per process are submitted at a time, so the order of the rest
+      #  can still change (--schedule cost).
+      pool = concurrent.futures.ProcessPoolExecutor(max_workers=int(options.nworkers), \
+                                  mp_context=multiprocessing.get_context('fork'), \
+                                  initializer=nffun.init_forked)
+      futures = {}
+      next_job = 0
       n_done = 0
-  
-      #send first np-1 jobs where np is number of processes
-      for n_job in range(1,size):
-          comm.send(n_job, dest=n_job, tag=1)
-          comm.send(0,     dest=n_job, tag=2)
-          if (options.postproc_only == False):
-              time.sleep(0.2)
-      #Assign rest of jobs on demand
-      for n_job in range(size,options.n+1):
-          process = comm.recv(source=MPI.ANY_SOURCE, tag=3)
-          thisjob = comm.recv(source=process, tag=4)
-          if (do_postproc):
-              data_row = comm.recv(source=process, tag=5)
-              data[:,thisjob-1] = data_row
-              parm_row = comm.recv(source=process, tag=6)
-              parms[:,thisjob-1] = parm_row
+      schedule(jobs, 0, 0)
+      while (n_done < len(jobs)):
+        while (next_job < len(jobs) and len(futures) < 2*int(options.nworkers)):
+          futures[pool.submit(local_job, jobs[next_job])] = jobs[next_job]
+          next_job = next_job+1
+        completed, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        t0 = time.time()
+        for future in completed:
+          task = futures.pop(future)
+          row = row_for(task)
+          try:
+            row[:], pid = future.result()
+          except Exception as e:
+            print('Error running member '+str(task_member(task))+': '+str(e))
+            row[:] = -999
+            row[0:data_cols] = np.nan
+            row[tcol:-1] = np.nan
+            row[-1] = 5
+            pid = -1
+          log_task(task, row, pid, hosts[0])
+          finished(task, row, 0)
           n_done = n_done+1
-          comm.send(n_job, dest=process, tag=1)
-          comm.send(0,     dest=process, tag=2)
-      #receive remaining messages and finalize
-      while (n_done < options.n):
-          process = comm.recv(source=MPI.ANY_SOURCE, tag=3)
-          thisjob = comm.recv(source=process, tag=4)
-          if (do_postproc):
-              data_row = comm.recv(source=process, tag=5)
-              data[:,thisjob-1] = data_row
-              parm_row = comm.recv(source=process, tag=6)
-              parms[:,thisjob-1] = parm_row
+          schedule(jobs, next_job, n_done)
+        progress['busy'] += time.time()-t0
+        write_progress()
+      pool.shutdown()
+      os.chdir(workdir)
+    elif (options.hierarchical):
+      #Two-level dispatch (see submaster):  rank 0 sends blocks of jobs to one sub-master
+      #  per node and receives their rows in blocks, so it handles one message per block
+      #  instead of two per job.  Each sub-master holds what its ranks can queue
+      #  (1+prefetch jobs each) and two blocks more, so its ranks stay busy while a block
+      #  of rows is on its way back, and is sent more as rows come back.
+      block = {}
+      capacity = {}
+      outstanding = {}
+      for sm in submasters:
+        capacity[sm] = hosts[1:].count(hosts[sm])*(1+int(options.prefetch))
+        block[sm] = int(options.block_size)
+        if (block[sm] <= 0):
+          block[sm] = hosts[1:].count(hosts[sm])
+        outstanding[sm] = 0
+      def send_block(s):
+        global next_job
+        tasks = []
+        while (next_job < len(jobs) and outstanding[s]+len(tasks) < capacity[s]+2*block[s]):
+          prefer_other(jobs, next_job, s)
+          tasks.append(jobs[next_job])
+          next_job = next_job+1
+        if (len(tasks) > 0):
+          comm.send(tasks, dest=s, tag=4)
+          outstanding[s] = outstanding[s]+len(tasks)
+      n_done = 0
+      next_job = 0
+      schedule(jobs, 0, 0)
+      for sm in submasters:
+        send_block(sm)
+      status = MPI.Status()
+      while (n_done < len(jobs)):
+        comm.Probe(source=MPI.ANY_SOURCE, tag=5, status=status)
+        process = status.Get_source()
+        t0 = time.time()
+        rows = np.zeros([status.Get_count(MPI.DOUBLE)//(ncols+2), ncols+2], float)
+        comm.Recv([rows, MPI.DOUBLE], source=process, tag=5)
+        for row in rows:
+          task = int(row[0])
+          row_for(task)[:] = row[2:]
+          log_task(task, row_for(task), int(row[1]))
+          finished(task, row_for(task), int(row[1]))
           n_done = n_done+1
-          comm.send(-1, dest=process, tag=1)
-          comm.send(-1, dest=process, tag=2)
+        outstanding[process] = outstanding[process]-len(rows)
+        schedule(jobs, next_job, n_done)
+        #refill this node first, then any others with room for jobs added since
+        send_block(process)
+        for sm in submasters:
+          send_block(sm)
+        progress['busy'] += time.time()-t0
+        write_progress()
+      for sm in submasters:
+        comm.send([-1], dest=sm, tag=4)
+    else:
+      for thisiter in range(0,niter):
+        n_done = 0
+  
+        #Each worker holds its current job plus options.prefetch queued jobs, so the
+        #  next one is already there when it finishes.  One message per direction:
+        #  the job number (-1 = no more jobs), and the result row back.  Workers run
+        #  their jobs in the order sent, so the sender identifies the job and the
+        #  row is received directly into results.
+        queued = [[] for process in range(0,size)]
+        def dispatch(process):
+          #send the next job to process, if any are left
+          global next_job
+          if (next_job >= len(jobs)):
+            return False
+          prefer_other(jobs, next_job, process)
+          comm.send(jobs[next_job], dest=process, tag=1)
+          queued[process].append(jobs[next_job])
+          next_job = next_job+1
+          return True
+        next_job = 0
+        schedule(jobs, 0, 0)
+        for d in range(0,1+int(options.prefetch)):
+          for process in range(first_worker,size):
+            dispatch(process)
+        #Workers with nothing left wait for jobs added later (retries and SPRUCE
+        #  treatments), and are all stopped once every job is done
+        idle = [process for process in range(first_worker,size) if len(queued[process]) == 0]
+        #Assign rest of jobs on demand
+        status = MPI.Status()
+        while (n_done < len(jobs)):
+            comm.Probe(source=MPI.ANY_SOURCE, tag=3, status=status)
+            process = status.Get_source()
+            t0 = time.time()
+            task = queued[process].pop(0)
+            comm.Recv([row_for(task), MPI.DOUBLE], source=process, tag=3)
+            log_task(task, row_for(task), process)
+            finished(task, row_for(task), process)
+            n_done = n_done+1
+            schedule(jobs, next_job, n_done)
+            #a retry goes to an idle rank first, on another node if possible, and back to
+            #  the rank it failed on only when no other rank is free
+            while (next_job < len(jobs) and jobs[next_job] in failed_on and len(idle) > 0):
+              bad = failed_on[jobs[next_job]]
+              others = [p for p in idle if hosts[p] != hosts[bad]]+[p for p in idle if p != bad]
+              if (len(others) == 0):
+                break
+              idle.remove(others[0])
+              dispatch(others[0])
+            if (not dispatch(process) and len(queued[process]) == 0):
+                idle.append(process)
+            while (len(idle) > 0 and next_job < len(jobs)):
+                dispatch(idle.pop(0))
+            progress['busy'] += time.time()-t0
+            write_progress()
+        for process in range(first_worker,size):
+            comm.send(-1, dest=process, tag=1)
+    write_progress(final=True)
+    telemetry.close()
+    journal.close()
+    failures.close()
+    if (len(attempts) > 0):
+      print(str(len(set([task_member(task) for task in attempts])))+' members failed at least once, '+str(len(lost))+ \
+            ' without a good run.  See '+failure_file)
+    if (options.result_store):
+      results.flush()
+    if (first_worker == 0):
+      local_worker.join()
+      os.chdir(workdir)
 
 
     #---------------------------Output post-processing---------------------------
     if (do_postproc):
-        data_out = data.transpose()
-        parm_out = parms.transpose()
+        data_out = results[:,0:data_cols]
+        parm_out = results[:,data_cols:data_cols+nparms]
         good=[]
         for i in range(0,options.n):
           #only save valid runs (no NaNs)
@@ -417,92 +1336,15 @@ if (rank == 0):
           if (max(myobs_err) > 0):
             #Run the MCMC calibration on surrogate model if data provided
             os.system('python MCMC.py --case '+options.casename+' --parm_list '+options.parm_list)
-    MPI.Finalize()
+    if (options.executor == 'mpi'):
+      MPI.Finalize()
 
 #--------------------- Slave process (individual ensemble members) --------------
 else:
-  for thisiter in range(0,niter):
-    status=0
-    while status == 0:
-        myjob = comm.recv(source=0, tag=1)
-        status = comm.recv(source=0, tag=2) 
-
-        if (status == 0):
-            if (options.postproc_only == False):
-                cnp = 'False'
-                if (options.cnp):
-                    cnp='True'
-                mycases=[]
-                mycases.append(options.casename)
-                for c in mycases:
-                  os.chdir(workdir)
-                  #Python script to set up the ensemble run directory and manipulate parameters
-                  os.system('python ensemble_copy.py --case '+c+' --runroot '+ \
-                        options.runroot +' --ens_num '+str(myjob)+' --ens_file '+options.ens_file+ \
-                        ' --parm_list '+options.parm_list+' --cnp '+cnp+' --site '+options.site+' --model_name '+ \
-                        options.model_name)
-                  jobst = str(100000+int(myjob))
-                  rundir = options.runroot+'/UQ/'+c+'/g'+jobst[1:]+'/'
-                  os.chdir(rundir)
-                  #Run the executable
-                  exedir = options.exeroot
-                  if os.path.isfile(exedir+'/acme.exe'):
-                     os.system(exedir+'/acme.exe > acme_log.txt')
-                  elif os.path.isfile(exedir+'/e3sm.exe'):
-                     os.system(exedir+'/e3sm.exe > e3sm_log.txt')
-                  elif os.path.isfile(exedir+'/cesm.exe'):
-                     os.system(exedir+'/cesm.exe > cesm_log.txt')
-                  if (options.spruce_treatments):
-                    #Transient/SP case should be set up produce 2015 restart file
-                    #Then we will loop over 11 cases and put results into subdirectories.
-                    treatments=['TAMB','T0.00','T2.25','T4.50','T6.75','T9.00', \
-                                'T0.00CO2','T2.25CO2','T4.50CO2','T6.75CO2','T9.00CO2']
-                    plots=[7,6,20,13,8,17,19,11,4,16,10]
-                    os.system('cp lnd_in lnd_in_orig')
-                    os.system('cp drv_in drv_in_orig')
-                    for t in range(0,len(treatments)):
-                      lnd_in_old=open('lnd_in_orig','r')
-                      lnd_in_new=open('lnd_in','w')
-                      pst = str(100+plots[t])[1:]
-                      for s in lnd_in_old:
-                        if ('finidat =' in s):
-                          lnd_in_new.write(" finidat = './"+c+"."+options.model_name+".r.2015-01-01-00000.nc'\n")
-                        elif ('metdata_bypass' in s):
-                          lnd_in_new.write(s[:-2]+'/plot'+pst+"'\n")
-                          if ('CO2' in treatments[t]):
-                            lnd_in_new.write(' add_co2 = 500\n')
-                            lnd_in_new.write(" startdate_add_co2 = '20160315'\n") 
-                        elif ('landuse_timeseries' in s):
-                          lnd_in_new.write(s.replace('plot07','plot'+pst))
-                        else:
-                          lnd_in_new.write(s)
-                      lnd_in_old.close()
-                      lnd_in_new.close()
-                      drv_in_old=open(rundir+'/drv_in_orig','r')
-                      drv_in_new=open(rundir+'/drv_in','w')
-                      for s in drv_in_old:
-                        if ('stop_n' in s):
-                          drv_in_new.write(' stop_n = 7\n')
-                        elif ('restart_n' in s):
-                          drv_in_new.write(' restart_n = 7\n')
-                        elif ('start_ymd' in s):
-                          drv_in_new.write(' start_ymd = 20150101\n')
-                        else:
-                          drv_in_new.write(s)
-                      drv_in_new.close()
-                      drv_in_old.close()
-                      os.system('mkdir '+rundir+'/'+treatments[t])
-                      os.system(exedir+'/e3sm.exe > e3sm_log_'+treatments[t]+'.txt')
-                      os.system('cp *.'+options.model_name+'.h?.20[1-2]*.nc '+treatments[t])
-            if (do_postproc):
-                ierr = postproc(myvars, myyear_start, myyear_end, myday_start, \
-                         myday_end, myavg_pd, myfactor, myoffset, mypft, mytreatment, myjob, \
-                         options.runroot, options.casename, pnames, ppfts, data_row, parm_row)
-                comm.send(rank, dest=0, tag=3)
-                comm.send(myjob, dest=0, tag=4)
-                comm.send(data_row, dest=0, tag=5)
-                comm.send(parm_row, dest=0, tag=6)
-            else:
-                comm.send(rank,  dest=0, tag=3)
-                comm.send(myjob, dest=0, tag=4)
+  if (options.hierarchical and gcomm.Get_rank() == 0):
+    submaster(gcomm)
+  elif (options.hierarchical):
+    worker(result_row, gcomm)
+  else:
+    worker(result_row, comm)
   MPI.Finalize()
@@ -1,26 +1,347 @@
 #Python utilities for reading and writing variables to a netcdf file
-#  using Scientific Python OR scipy, whichever available
+#  using netCDF4, with memory-mapped (scipy) reads for classic-format files
 
-def getvar(fname, varname):
+import os, sys, time, json, atexit, threading, warnings
+from collections import OrderedDict
+
+#Cache of open Dataset handles, keyed by absolute path (least recently used first).
+#  A handle opened in append mode also serves reads of the same file.  Each entry
+#  remembers the inode it was opened on, so a file replaced on disk by an external
+#  tool (cp/mv, nccopy, ncks -O, ncap2 -O) is reopened instead of read stale.
+#  Call close_all() before an external tool modifies a file in place.
+#  Mode 'm' entries are read-only memory maps of classic files used by getview().
+max_open = 16          #set to 0 to disable caching (open/close on every call)
+_handles = OrderedDict()
+_lock = threading.RLock()
+
+#Opt-in I/O instrumentation.  Set OLMT_NCSTATS=1 to print a summary table of opens,
+#  reads, writes, bytes and wall time per file and variable at exit, or set it to a
+#  file name ending in .json to write the counters there instead ({pid} is replaced
+#  by the process id, for use with several MPI ranks or pool processes).
+_stats_out = os.environ.get('OLMT_NCSTATS', '')
+_stats = None
+if (_stats_out not in ['', '0']):
+    _stats = {}
+_t_start = time.time()
+
+def _count(fname, varname, kind, varvals, t0):
+    #add one open/read/write (and its bytes and wall time) to the counters
+    import numpy
+    fstats = _stats.setdefault(os.path.abspath(fname), {'opens': 0, 'open_time': 0.0, 'vars': {}})
+    if (kind == 'open'):
+      fstats['opens'] += 1
+      fstats['open_time'] += time.time()-t0
+      return
+    vstats = fstats['vars'].setdefault(varname, {'reads': 0, 'writes': 0, 'bytes_read': 0, \
+                                                 'bytes_written': 0, 'time': 0.0})
+    if (kind == 'read'):
+      vstats['reads'] += 1
+      vstats['bytes_read'] += numpy.asarray(varvals).nbytes
+    else:
+      vstats['writes'] += 1
+      vstats['bytes_written'] += numpy.asarray(varvals).nbytes
+    vstats['time'] += time.time()-t0
+
+def iostats():
+    #counters collected so far (None if instrumentation is off)
+    return _stats
+
+def print_iostats(out=None):
+    if (_stats is None):
+      return
+    if (out is None):
+      out = sys.stdout
+    elapsed = time.time()-_t_start
+    io_time = 0.0
+    out.write('%-60s %-24s %7s %7s %7s %12s %12s %9s\n'%('file', 'variable', 'opens', 'reads', \
+              'writes', 'MB read', 'MB written', 'time (s)'))
+    for f in sorted(_stats):
+      fstats = _stats[f]
+      out.write('%-60s %-24s %7d %7s %7s %12s %12s %9.3f\n'%(f[-60:], '(file opens)', \
+                fstats['opens'], '', '', '', '', fstats['open_time']))
+      io_time += fstats['open_time']
+      for v in sorted(fstats['vars']):
+        vstats = fstats['vars'][v]
+        out.write('%-60s %-24s %7s %7d %7d %12.3f %12.3f %9.3f\n'%('', v[:24], '', vstats['reads'], \
+                  vstats['writes'], vstats['bytes_read']/1.0e6, vstats['bytes_written']/1.0e6, vstats['time']))
+        io_time += vstats['time']
+    out.write('netCDF I/O: %.3f s of %.3f s process wall time (%.1f%%)\n'%(io_time, elapsed, \
+              100.0*io_time/max(elapsed, 1e-9)))
+
+def _report_stats():
+    if (_stats is None):
+      return
+    if (_stats_out.endswith('.json')):
+      myoutput = open(_stats_out.replace('{pid}', str(os.getpid())), 'w')
+      json.dump({'elapsed': time.time()-_t_start, 'files': _stats}, myoutput, indent=1)
+      myoutput.close()
+    else:
+      print_iostats()
+
+def _fileid(fname):
+    st = os.stat(fname)
+    return (st.st_dev, st.st_ino)
+
+def fileformat(fname):
+    #file format from the magic number:  NETCDF3_CLASSIC, NETCDF3_64BIT_OFFSET,
+    #  NETCDF3_64BIT_DATA (CDF-5) or NETCDF4 (HDF5-based, including NETCDF4_CLASSIC)
+    myinput = open(fname, 'rb')
+    magic = myinput.read(4)
+    myinput.close()
+    if (magic == b'CDF\x01'):
+      return 'NETCDF3_CLASSIC'
+    elif (magic == b'CDF\x02'):
+      return 'NETCDF3_64BIT_OFFSET'
+    elif (magic == b'CDF\x05'):
+      return 'NETCDF3_64BIT_DATA'
+    return 'NETCDF4'
+
+def _close_file(nffile):
+    try:
+      with warnings.catch_warnings():
+        #scipy warns when views into a memory map outlive the file; they stay valid
+        warnings.simplefilter('ignore', RuntimeWarning)
+        nffile.close()
+    except RuntimeError:
+      pass       #already closed (e.g. file removed underneath us)
+
+def _close_handle(key):
+    _close_file(_handles.pop(key)[0])
+
+def _open_mmap(fname):
+    #scipy memory-maps CDF-1 and CDF-2 files; anything else goes through netCDF4
+    if (fileformat(fname) in ['NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET']):
+      try:
+        from scipy.io import netcdf_file
+        return netcdf_file(fname, 'r', mmap=True)
+      except ImportError:
+        pass
     from netCDF4 import Dataset
-    nffile = Dataset(fname,"r")
-    if varname in nffile.variables:
-      varvals = nffile.variables[varname][:]
+    return Dataset(fname, 'r')
+
+def _open(fname, mode):
+    from netCDF4 import Dataset
+    key = os.path.abspath(fname)
+    if (key in _handles):
+      nffile, thismode, fileid = _handles[key]
+      try:
+        valid = (fileid == _fileid(fname))
+      except OSError:
+        valid = False
+      if (valid and (thismode == mode or (thismode == 'a' and mode != 'a'))):
+        _handles.move_to_end(key)
+        return nffile
+      _close_handle(key)
+    t0 = time.time()
+    if (mode == 'm'):
+      nffile = _open_mmap(fname)
     else:
-      # print('Warning: '+varname+' not in '+fname)
-      raise ValueError('"%s" not in %s'%(varname,fname))
-      varvals=[-1]
-    nffile.close()
+      nffile = Dataset(fname, mode)
+    if (_stats is not None):
+      _count(fname, None, 'open', None, t0)
+    if (max_open > 0):
+      _handles[key] = (nffile, mode, _fileid(fname))
+      while (len(_handles) > max_open):
+        _close_handle(next(iter(_handles)))
+    return nffile
+
+def _release(nffile):
+    #close handles that are not held by the cache
+    if (max_open <= 0):
+      _close_file(nffile)
+
+def set_cache_size(n):
+    global max_open
+    with _lock:
+      max_open = int(n)
+      while (len(_handles) > max(max_open, 0)):
+        _close_handle(next(iter(_handles)))
+
+def flush_all():
+    with _lock:
+      for key in _handles:
+        if (_handles[key][1] == 'a'):
+          _handles[key][0].sync()
+
+def close_all(fname=None):
+    #close every cached handle, or only the one for fname
+    with _lock:
+      if (fname is None):
+        for key in list(_handles.keys()):
+          _close_handle(key)
+      elif (os.path.abspath(fname) in _handles):
+        _close_handle(os.path.abspath(fname))
+
+def _exit():
+    close_all()
+    _report_stats()
+
+atexit.register(_exit)
+
+_inherited = []
+def init_forked():
+    #initializer for the processes of a forked pool (multiprocessing).  These exit without
+    #  running atexit hooks, so handles are closed and the I/O statistics reported by a
+    #  multiprocessing finalizer instead.  Handles and counters inherited from the parent
+    #  are left to the parent.
+    global _stats, _t_start
+    import multiprocessing.util
+    with _lock:
+      _inherited.extend(_handles.values())
+      _handles.clear()
+      if (_stats is not None):
+        _stats = {}
+      _t_start = time.time()
+    multiprocessing.util.Finalize(None, _exit, exitpriority=10)
+
+def _hyperslab(index, trange):
+    #build the indexing key for a variable read.  trange = (start, end) selects a range
+    #  of the first (time) dimension (end exclusive); index then applies to the remaining
+    #  dimensions.  Without trange, index applies to the variable as given.
+    if (trange is None):
+      if (index is None):
+        return slice(None)
+      return index
+    key = (slice(trange[0], trange[1]),)
+    if (index is not None):
+      if (isinstance(index, tuple)):
+        key = key + index
+      else:
+        key = key + (index,)
+    return key
+
+def getvar(fname, varname, index=None, trange=None):
+    #index/trange restrict the read to a hyperslab (see _hyperslab); default reads all
+    with _lock:
+      nffile = _open(fname,"r")
+      t0 = time.time()
+      if varname in nffile.variables:
+        varvals = nffile.variables[varname][_hyperslab(index, trange)]
+        if (_stats is not None):
+          _count(fname, varname, 'read', varvals, t0)
+      else:
+        # print('Warning: '+varname+' not in '+fname)
+        _release(nffile)
+        raise ValueError('"%s" not in %s'%(varname,fname))
+      _release(nffile)
+    return varvals
+
+def getshape(fname, varname):
+    #dimensions of a variable, from the header only
+    with _lock:
+      nffile = _open(fname,"r")
+      if varname in nffile.variables:
+        varshape = nffile.variables[varname].shape
+      else:
+        _release(nffile)
+        raise ValueError('"%s" not in %s'%(varname,fname))
+      _release(nffile)
+    return varshape
+
+def getview(fname, varname, index=None, trange=None):
+    #read-only, zero-copy view of a variable in a classic (CDF-1/CDF-2) file, backed by
+    #  a memory map of the file.  Values are raw (no _FillValue masking or scaling), see
+    #  later in-place writes to the file, and must be copied before modifying.
+    #  Other formats are read through netCDF4.
+    with _lock:
+      nffile = _open(fname,"m")
+      t0 = time.time()
+      if varname in nffile.variables:
+        var = nffile.variables[varname]
+        if (hasattr(var, 'data') and var.shape == ()):
+          varvals = var.data          #scalar variable in a memory-mapped file
+        else:
+          varvals = var[_hyperslab(index, trange)]
+        if (_stats is not None):
+          _count(fname, varname, 'read', varvals, t0)
+      else:
+        _release(nffile)
+        raise ValueError('"%s" not in %s'%(varname,fname))
+      _release(nffile)
     return varvals
 
 def putvar(fname, varname, varvals):
+    with _lock:
+      nffile = _open(fname,"a")
+      t0 = time.time()
+      if (varname in nffile.variables):
+        nffile.variables[varname][...] = varvals
+        #write through so external tools (and other processes) see the new values
+        nffile.sync()
+        if (_stats is not None):
+          _count(fname, varname, 'write', varvals, t0)
+      else:
+        print('Warning: '+varname+' not in '+fname)
+      _release(nffile)
+    ierr = 0
+    return ierr
+
+def getvars(fname, varnames, slabs=None):
+    #read several variables in a single open; values are returned in the order requested.
+    #  slabs optionally gives an (index, trange) hyperslab for each variable (see _hyperslab)
+    with _lock:
+      nffile = _open(fname,"r")
+      varvals = []
+      for i in range(0,len(varnames)):
+        varname = varnames[i]
+        t0 = time.time()
+        if varname in nffile.variables:
+          if (slabs is None):
+            varvals.append(nffile.variables[varname][:])
+          else:
+            varvals.append(nffile.variables[varname][_hyperslab(slabs[i][0], slabs[i][1])])
+          if (_stats is not None):
+            _count(fname, varname, 'read', varvals[-1], t0)
+        else:
+          _release(nffile)
+          raise ValueError('"%s" not in %s'%(varname,fname))
+      _release(nffile)
+    return varvals
+
+def putvars(fname, varvals):
+    #write a dictionary of {varname: values} in a single open
+    with _lock:
+      nffile = _open(fname,"a")
+      for varname in varvals:
+        t0 = time.time()
+        if (varname in nffile.variables):
+          nffile.variables[varname][...] = varvals[varname]
+          if (_stats is not None):
+            _count(fname, varname, 'write', varvals[varname], t0)
+        else:
+          print('Warning: '+varname+' not in '+fname)
+      nffile.sync()
+      _release(nffile)
+    ierr = 0
+    return ierr
+
+def copyvars(fname, fname_out, varnames):
+    #write a new file with only varnames (and the dimensions and global attributes
+    #  they need) from fname, in the same format.  Variables not in fname are skipped.
     from netCDF4 import Dataset
-    import numpy as np
-    nffile = Dataset(fname,"a")
-    if (varname in nffile.variables):
-      nffile.variables[varname][...] = varvals
-    else:
-      print('Warning: '+varname+' not in '+fname)
-    nffile.close()
+    with _lock:
+      nffile = _open(fname,"r")
+      t0 = time.time()
+      outfile = Dataset(fname_out, 'w', format=nffile.data_model)
+      outfile.setncatts(dict([(a, nffile.getncattr(a)) for a in nffile.ncattrs()]))
+      for varname in varnames:
+        if (not varname in nffile.variables or varname in outfile.variables):
+          continue
+        var = nffile.variables[varname]
+        for d in var.dimensions:
+          if (not d in outfile.dimensions):
+            if (nffile.dimensions[d].isunlimited()):
+              outfile.createDimension(d, None)
+            else:
+              outfile.createDimension(d, len(nffile.dimensions[d]))
+        outvar = outfile.createVariable(varname, var.dtype, var.dimensions, \
+                                        fill_value=getattr(var, '_FillValue', None))
+        outvar.setncatts(dict([(a, var.getncattr(a)) for a in var.ncattrs() if a != '_FillValue']))
+        varvals = var[...]
+        outvar[...] = varvals
+        if (_stats is not None):
+          _count(fname, varname, 'read', varvals, t0)
+      outfile.close()
+      _release(nffile)
     ierr = 0
     return ierr
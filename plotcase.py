@@ -3,17 +3,16 @@
 import os, sys, csv, glob
 import numpy, scipy, math
 from netCDF4 import Dataset
+import netcdf4_functions as nffun
 from optparse import OptionParser
 import matplotlib as mpl
 
 def getvar(fname, varname, npf, index, scale_factor):
-    nffile = Dataset(fname,"r")
-    var = nffile.variables[varname]
     if (index < 0):  #average over all sites/PFTs (not weighted) 
-         varvals = numpy.nanmean(var[0:npf,:], axis=1) * scale_factor
+         varvals = numpy.nanmean(nffun.getvar(fname, varname, trange=(0,npf)), axis=1) * scale_factor
     else:
-         varvals = var[0:npf,index] * scale_factor
-    nffile.close()
+         #read only the requested site/PFT column
+         varvals = nffun.getvar(fname, varname, index=index, trange=(0,npf)) * scale_factor
     return varvals
 
 
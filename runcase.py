@@ -923,6 +923,9 @@ if (options.mymodel == 'ELM'):
                 ierr = nffun.putvar(soilorderfile, values[0], thisvar)
         input.close()
 
+#parameter files are final; release cached netcdf handles
+nffun.close_all()
+
 #set number of run years for ad, exit spinup cases
 if (options.ny_ad != options.run_n and options.ad_spinup):
     options.run_n = options.ny_ad
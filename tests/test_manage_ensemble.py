@@ -0,0 +1,60 @@
+#Tests of manage_ensemble.py run as a script with the local executor on a toy case:
+#  a parent run directory with only an lnd_in, co2 as the one parameter and a fake
+#  model executable that writes an (empty) history file.
+
+import os, sys, subprocess, textwrap
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'manage_ensemble.py')
+case = 'US-Test_I20TRCNPRDCTCBC'
+
+def make_case(tmp_path, n, message='ok'):
+    rundir = tmp_path / 'run' / case / 'run'
+    rundir.mkdir(parents=True)
+    (rundir / 'lnd_in').write_text(" &clm_inparm\n co2_ppmv = 367.0\n/\n")
+    exedir = tmp_path / 'exe'
+    exedir.mkdir()
+    exe = exedir / 'e3sm.exe'
+    exe.write_text(textwrap.dedent('''\
+        #!/bin/sh
+        touch %s.clm2.h0.2000-01-01-00000.nc
+        echo "%s"
+        ''' % (case, message)))
+    exe.chmod(0o755)
+    (tmp_path / 'parm_list').write_text('co2 0 300 400\n')
+    (tmp_path / 'ens.txt').write_text(''.join(['%d\n' % (300+10*i) for i in range(0,n)]))
+
+def run_ensemble(tmp_path, *args):
+    myoutput = subprocess.run([sys.executable, script, '--executor', 'local', '--nworkers', '2', \
+                               '--case', case, '--runroot', 'run', '--exeroot', 'exe', \
+                               '--ens_file', 'ens.txt', '--parm_list', 'parm_list']+list(args), \
+                              cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+                              universal_newlines=True)
+    assert myoutput.returncode == 0, myoutput.stdout
+    return myoutput.stdout
+
+def test_resume_without_postproc(tmp_path):
+    make_case(tmp_path, 4)
+    run_ensemble(tmp_path)
+    journal = (tmp_path / (case+'_journal.txt')).read_text().splitlines()
+    assert len(journal) == 4
+    output = run_ensemble(tmp_path, '--resume')
+    assert 'Resuming: 4 of 4 members already complete' in output
+
+def test_resume_reruns_failed_member(tmp_path):
+    make_case(tmp_path, 3)
+    run_ensemble(tmp_path)
+    #mark member 2 as failed (failure code in the last column) in the journal
+    journal_file = tmp_path / (case+'_journal.txt')
+    lines = journal_file.read_text().splitlines()
+    lines = [l if l.split()[0] != '2' else ' '.join(l.split()[:-1]+['1']) for l in lines]
+    journal_file.write_text('\n'.join(lines)+'\n')
+    output = run_ensemble(tmp_path, '--resume')
+    assert 'Resuming: 2 of 3 members already complete' in output
+
+def test_log_error_patterns(tmp_path):
+    #the word ERROR inside a log line is not an error message
+    make_case(tmp_path, 2, message='0 ERROR messages from the land model')
+    output = run_ensemble(tmp_path, '--max_retries', '0')
+    assert 'failed' not in output
+    failures = (tmp_path / (case+'_failures.txt')).read_text().splitlines()
+    assert len(failures) == 1